@@ -0,0 +1,60 @@
+# Benchmark: plain greedy vs assisted (speculative) greedy decoding, batch size 1 on CPU
+# Checks that outputs are byte-identical and reports acceptance rate + end-to-end speedup.
+# Run (from Code/):
+#   python training_code/bench_assisted_decoding.py --adapter_name lora_tinyllama_min \
+#          --prompts_file ./test_prompts.jsonl --n_prompts 10 --draft_model prompt_lookup
+#   python training_code/bench_assisted_decoding.py ... --draft_model JackFram/llama-68m
+from pathlib import Path
+import sys, argparse, time
+from types import SimpleNamespace
+
+THIS_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(THIS_DIR))
+from infer_lora_min import (P, PRECISIONS, read_prompts, load_model, gen_kwargs_from_args,
+                            generate_batch, load_assist, assist_summary)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--base_model", default="TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+    ap.add_argument("--adapter_name", default="lora_tinyllama_min")
+    ap.add_argument("--prompts_file", required=True)
+    ap.add_argument("--n_prompts", type=int, default=10)
+    ap.add_argument("--max_new_tokens", type=int, default=160)
+    ap.add_argument("--draft_model", default="prompt_lookup")
+    ap.add_argument("--num_draft_tokens", type=int, default=10)
+    ap.add_argument("--merged", action="store_true")
+    ap.add_argument("--precision", choices=PRECISIONS, default="fp32")
+    args = ap.parse_args()
+
+    adapter_dir = P.OUTPUT_DIR / args.adapter_name
+    if not adapter_dir.exists():
+        raise FileNotFoundError(f"Adapter not found: {adapter_dir}")
+    prompts = read_prompts(args.prompts_file)[:args.n_prompts]
+    tok, model = load_model(args.base_model, adapter_dir, merged=args.merged, precision=args.precision)
+    assist = load_assist(args.draft_model, tok, args.num_draft_tokens, args.precision)
+    gen_kwargs = gen_kwargs_from_args(tok, SimpleNamespace(max_new_tokens=args.max_new_tokens,
+                                                           temperature=0.0, greedy=True))
+
+    plain, plain_stats, t_plain = [], {}, 0.0
+    fast, fast_stats, t_fast = [], {}, 0.0
+    for p in prompts:  # interleave so thermal/turbo drift hits both paths alike
+        t0 = time.perf_counter()
+        plain += generate_batch(tok, model, [p], gen_kwargs, plain_stats)
+        t_plain += time.perf_counter() - t0
+        t0 = time.perf_counter()
+        fast += generate_batch(tok, model, [p], gen_kwargs, fast_stats, assist=assist)
+        t_fast += time.perf_counter() - t0
+
+    same = sum(a == b for a, b in zip(plain, fast))
+    print("==================================================")
+    print(f"prompts: {len(prompts)} | draft: {args.draft_model} | max_new_tokens: {args.max_new_tokens}")
+    print(f"plain greedy   : {t_plain:.1f}s ({plain_stats['new_tokens'] / t_plain:.1f} tok/s)")
+    print(f"assisted greedy: {t_fast:.1f}s ({fast_stats['new_tokens'] / t_fast:.1f} tok/s)")
+    print(f"speedup        : {t_plain / t_fast:.2f}x")
+    print(f"assist         : {assist_summary(fast_stats)}")
+    print(f"identical outputs: {same}/{len(prompts)} {'✅' if same == len(prompts) else '⚠️'}")
+
+
+if __name__ == "__main__":
+    main()
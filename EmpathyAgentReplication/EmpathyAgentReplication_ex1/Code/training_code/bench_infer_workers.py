@@ -0,0 +1,66 @@
+# Benchmark: aggregate inference tokens/sec vs number of data-parallel workers (infer_lora_min.py --workers N)
+# Every run regenerates the same prompts (--refresh_cache, --greedy) and is compared with the --workers 1 baseline;
+# outputs must match across worker counts. Throughput is wall clock incl. model loads, as in infer_throughput.csv.
+# Run (from Code/):
+#   python training_code/bench_infer_workers.py --adapter_name lora_tinyllama_min \
+#          --prompts_file ./test_prompts.jsonl --workers 1 2 4 --max_new_tokens 160
+from pathlib import Path
+import sys, argparse, json, csv, subprocess
+
+THIS_DIR = Path(__file__).resolve().parent
+CODE_DIR = THIS_DIR.parent
+sys.path.insert(0, str(CODE_DIR))
+import cfg_paths as P
+from infer_lora_min import last_throughput_row
+
+
+def read_outputs(path: Path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line).get("output") for line in f if line.strip()]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--base_model", default="TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+    ap.add_argument("--adapter_name", default="lora_tinyllama_min")
+    ap.add_argument("--prompts_file", required=True)
+    ap.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    ap.add_argument("--max_new_tokens", type=int, default=160)
+    ap.add_argument("--batch_size", type=int, default=1)
+    args = ap.parse_args()
+    counts = sorted(set([1] + args.workers))  # the single-process baseline always runs
+
+    adir = P.OUTPUT_DIR / args.adapter_name
+    rows, outputs = [], {}
+    for n in counts:
+        out_file = f"inference_workers{n}.jsonl"
+        cmd = [sys.executable, str(THIS_DIR / "infer_lora_min.py"), "--base_model", args.base_model,
+               "--adapter_name", args.adapter_name, "--prompts_file", args.prompts_file,
+               "--max_new_tokens", str(args.max_new_tokens), "--batch_size", str(args.batch_size),
+               "--greedy", "--workers", str(n), "--out_file", out_file, "--refresh_cache"]
+        print(f"[bench] workers={n}: {' '.join(cmd[1:])}")
+        subprocess.run(cmd, check=True)
+        tp = last_throughput_row()
+        outputs[n] = read_outputs(adir / out_file)
+        rows.append({"workers": n, "threads_per_worker": int(tp["threads_per_worker"]), "seconds": float(tp["seconds"]),
+                     "tokens_per_s": float(tp["tokens_per_s"]), "peak_rss_mb": float(tp["peak_rss_mb"])})
+
+    base = rows[0]
+    out_csv = adir / "workers_compare.csv"
+    with open(out_csv, "w", newline="", encoding="utf-8") as wf:
+        w = csv.writer(wf)
+        w.writerow(["workers", "threads_per_worker", "seconds", "tokens_per_s", "speedup", "identical_outputs"])
+        print("==================================================")
+        print(f"{'workers':>7} {'threads':>8} {'seconds':>8} {'tok/s':>9} {'speedup':>8}  outputs vs workers=1")
+        for r in rows:
+            same = sum(a == b for a, b in zip(outputs[r["workers"]], outputs[1]))
+            speedup = r["tokens_per_s"] / base["tokens_per_s"]
+            w.writerow([r["workers"], r["threads_per_worker"], f"{r['seconds']:.2f}", f"{r['tokens_per_s']:.2f}",
+                        f"{speedup:.2f}", f"{same}/{len(outputs[1])}"])
+            print(f"{r['workers']:>7} {r['threads_per_worker']:>8} {r['seconds']:>8.1f} {r['tokens_per_s']:>9.1f} "
+                  f"{speedup:>7.2f}x  {same}/{len(outputs[1])} {'✅' if same == len(outputs[1]) else '⚠️'}")
+    print(f"✅ wrote {out_csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# Check + benchmark: bit-parallel lcs_length() vs the O(m·n) dynamic program
+# 1) random token lists (small alphabets → many repeats) and lcs_norm's empty-string edge cases must agree
+# 2) timing on plan-sized texts (prompt echo + --max_new_tokens 160 ≈ several hundred tokens each)
+# Run (from Code/):
+#   python training_code/bench_lcs.py --pairs 5000 --timing_pairs 200 --tokens 600
+from pathlib import Path
+import sys, argparse, random, time
+
+THIS_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(THIS_DIR))
+from score_actions_min import _tok, lcs_length, lcs_norm
+
+
+def lcs_length_dp(x, y) -> int:
+    """Textbook LCS DP, one row at a time: a match extends the diagonal (previous row, previous column)."""
+    dp = [0] * (len(y) + 1)
+    for a in x:
+        diag = 0
+        for j, b in enumerate(y, 1):
+            diag, dp[j] = dp[j], diag + 1 if a == b else max(dp[j], dp[j - 1])
+    return dp[-1]
+
+
+def lcs_norm_dp(a: str, b: str) -> float:
+    x, y = _tok(a), _tok(b)
+    if not x and not y: return 1.0
+    if not x or not y:  return 0.0
+    return lcs_length_dp(x, y) / max(len(x), len(y))
+
+
+def old_lcs_length(x, y) -> int:
+    """The loop lcs_norm() used before: on a match it took the left cell + 1 instead of the diagonal."""
+    m, n = len(x), len(y)
+    dp = [0]*(n+1)
+    for _ in range(1, m+1):
+        prev = 0
+        for j in range(1, n+1):
+            tmp, prev = dp[j], dp[j-1]+1 if x[_-1]==y[j-1] else max(dp[j], dp[j-1])
+            dp[j] = prev
+            prev = tmp
+    return dp[n]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pairs", type=int, default=5000, help="Random pairs checked against the DP.")
+    ap.add_argument("--timing_pairs", type=int, default=200)
+    ap.add_argument("--tokens", type=int, default=600, help="Words per text in the timing run.")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+    rng = random.Random(args.seed)
+
+    edge = [("", ""), ("", "a b"), ("a b", ""), ("...", "!!"), ("?", "a"), ("a", "a"), ("A, b!", "a b")]
+    for a, b in edge:
+        assert lcs_norm(a, b) == lcs_norm_dp(a, b), (a, b)
+    mismatches = old_wrong = 0
+    for _ in range(args.pairs):
+        alphabet = rng.choice(["ab", "abcd", "abcdefghij", [f"w{i}" for i in range(200)]])
+        x = [rng.choice(alphabet) for _ in range(rng.randint(0, rng.choice([5, 40, 300])))]
+        y = [rng.choice(alphabet) for _ in range(rng.randint(0, rng.choice([5, 40, 300])))]
+        want = lcs_length_dp(x, y)
+        mismatches += lcs_length(x, y) != want
+        old_wrong += old_lcs_length(x, y) != want
+    print(f"[check] {len(edge)} edge cases + {args.pairs} random pairs: {mismatches} mismatches "
+          f"{'✅' if not mismatches else '⚠️'} (the previous lcs_norm loop was off on {old_wrong})")
+
+    vocab = [f"w{i}" for i in range(2000)]
+    texts = [" ".join(rng.choices(vocab, k=args.tokens)) for _ in range(2 * args.timing_pairs)]
+    pairs = list(zip(texts[::2], texts[1::2]))
+    t0 = time.perf_counter()
+    fast = [lcs_norm(a, b) for a, b in pairs]
+    t_fast = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    slow = [lcs_norm_dp(a, b) for a, b in pairs]
+    t_slow = time.perf_counter() - t0
+    assert fast == slow
+    print(f"[timing] {len(pairs)} pairs × {args.tokens} tokens: DP {t_slow:.2f}s, bit-parallel {t_fast:.3f}s "
+          f"→ {t_slow / t_fast:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# Benchmark: PeftModel (unmerged LoRA) vs adapter merged into base weights, CPU decode speed + parity
+# Run (from Code/):
+#   python training_code/bench_merged_adapter.py --adapter_name lora_tinyllama_min \
+#          --prompts_file ./test_prompts.jsonl --n_prompts 8 --new_tokens 64
+from pathlib import Path
+import sys, argparse, time
+import torch
+
+THIS_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(THIS_DIR))
+from infer_lora_min import P, fmt, read_prompts, load_model
+
+# Documented tolerance for --merged in fp32: merging only re-associates W·x + B·(A·x)·s into
+# (W + s·B·A)·x, so last-position logits should agree to well under this bound.
+LOGIT_ATOL = 1e-3
+
+
+def last_logits(tok, model, prompts):
+    out = []
+    with torch.no_grad():
+        for p in prompts:
+            ids = tok(p, return_tensors="pt")
+            out.append(model(**ids).logits[0, -1].float())
+    return torch.stack(out)
+
+
+def time_decode(tok, model, prompts, new_tokens: int):
+    """Greedy decode exactly `new_tokens` per prompt (batch size 1) → (seconds/token, token ids)."""
+    ids_out, secs = [], 0.0
+    with torch.no_grad():
+        for p in prompts:
+            ids = tok(p, return_tensors="pt")
+            t0 = time.perf_counter()
+            out = model.generate(**ids, max_new_tokens=new_tokens, min_new_tokens=new_tokens,
+                                 do_sample=False, num_beams=1, pad_token_id=tok.eos_token_id)
+            secs += time.perf_counter() - t0
+            ids_out.append(out[0, ids["input_ids"].shape[1]:].tolist())
+    return secs / (new_tokens * len(prompts)), ids_out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--base_model", default="TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+    ap.add_argument("--adapter_name", default="lora_tinyllama_min")
+    ap.add_argument("--prompts_file", default=None)
+    ap.add_argument("--n_prompts", type=int, default=8)
+    ap.add_argument("--new_tokens", type=int, default=64)
+    args = ap.parse_args()
+
+    adapter_dir = P.OUTPUT_DIR / args.adapter_name
+    if not adapter_dir.exists():
+        raise FileNotFoundError(f"Adapter not found: {adapter_dir}")
+    if args.prompts_file:
+        prompts = read_prompts(args.prompts_file)[:args.n_prompts]
+    else:
+        prompts = [fmt("You are an empathetic assistant. A teen is overwhelmed after a fight with a sibling. "
+                       "Offer a brief plan with 2 concrete, kind actions the caregiver can take right now.")]
+
+    # Same model object before and after merge_and_unload() → one fp32 copy in RAM
+    tok, model = load_model(args.base_model, adapter_dir)
+    ref_logits = last_logits(tok, model, prompts)
+    spt_lora, ids_lora = time_decode(tok, model, prompts, args.new_tokens)
+
+    model = model.merge_and_unload()
+    model.eval()
+    merged_logits = last_logits(tok, model, prompts)
+    spt_merged, ids_merged = time_decode(tok, model, prompts, args.new_tokens)
+
+    max_diff = float((ref_logits - merged_logits).abs().max())
+    same = sum(a == b for a, b in zip(ids_lora, ids_merged))
+    print("==================================================")
+    print(f"prompts: {len(prompts)} | new tokens/prompt: {args.new_tokens} | threads: {torch.get_num_threads()}")
+    print(f"PeftModel (unmerged): {spt_lora * 1000:.1f} ms/token ({1 / spt_lora:.1f} tok/s)")
+    print(f"Merged              : {spt_merged * 1000:.1f} ms/token ({1 / spt_merged:.1f} tok/s)")
+    print(f"Speedup             : {spt_lora / spt_merged:.2f}x")
+    print(f"max |Δ logit|       : {max_diff:.2e} (tolerance {LOGIT_ATOL:.0e}) "
+          f"{'✅' if max_diff <= LOGIT_ATOL else '⚠️'}")
+    print(f"identical greedy continuations: {same}/{len(prompts)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# Compare CPU inference precisions (fp32 / bf16 / int8-dynamic): tokens/sec, peak RSS, metric deltas
+# Each precision runs infer_lora_min.py in its own process (so peak RSS is per mode),
+# writes inference_<precision>.jsonl, and is scored with the score_actions_min.py metrics.
+# Run (from Code/):
+#   python training_code/bench_precision.py --adapter_name lora_tinyllama_min \
+#          --prompts_file ./test_prompts.jsonl --references ./test_refs.jsonl --max_new_tokens 160
+from pathlib import Path
+import sys, argparse, json, csv, subprocess
+
+THIS_DIR = Path(__file__).resolve().parent
+CODE_DIR = THIS_DIR.parent
+sys.path.insert(0, str(THIS_DIR))
+sys.path.insert(0, str(CODE_DIR))
+import cfg_paths as P
+from score_actions_min import jaccard, lcs_norm, tfidf_cosine_batch, read_references
+from infer_lora_min import PRECISIONS, last_throughput_row  # no torch import at module level
+
+
+def read_outputs(path: Path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line).get("output") or "" for line in f if line.strip()]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--base_model", default="TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+    ap.add_argument("--adapter_name", default="lora_tinyllama_min")
+    ap.add_argument("--prompts_file", required=True)
+    ap.add_argument("--references", required=True)
+    ap.add_argument("--max_new_tokens", type=int, default=160)
+    ap.add_argument("--batch_size", type=int, default=8)
+    ap.add_argument("--precisions", nargs="+", default=list(PRECISIONS), choices=PRECISIONS)
+    ap.add_argument("--merged", action="store_true", help="Pass --merged to every run.")
+    args = ap.parse_args()
+
+    adir = P.OUTPUT_DIR / args.adapter_name
+    refs_path = (CODE_DIR / args.references) if not Path(args.references).exists() else Path(args.references)
+    refs = read_references(refs_path)
+
+    rows = []
+    for prec in args.precisions:
+        out_file = f"inference_{prec}.jsonl"
+        cmd = [sys.executable, str(THIS_DIR / "infer_lora_min.py"),
+               "--base_model", args.base_model, "--adapter_name", args.adapter_name,
+               "--prompts_file", args.prompts_file, "--max_new_tokens", str(args.max_new_tokens),
+               "--batch_size", str(args.batch_size), "--greedy", "--precision", prec,
+               "--out_file", out_file, "--refresh_cache"]  # refresh: measure real generation, not cache hits
+        if args.merged:
+            cmd.append("--merged")
+        print(f"[bench] {prec}: {' '.join(cmd[1:])}")
+        subprocess.run(cmd, check=True)
+        tp = last_throughput_row()
+
+        preds = read_outputs(adir / out_file)
+        n = min(len(preds), len(refs))
+        preds_n, refs_n = preds[:n], refs[:n]
+        avg = lambda xs: sum(xs) / len(xs)
+        rows.append({
+            "precision": prec,
+            "tokens_per_s": float(tp["tokens_per_s"]),
+            "peak_rss_mb": float(tp["peak_rss_mb"]),
+            "Overlap": avg([jaccard(p, r) for p, r in zip(preds_n, refs_n)]),
+            "LCS": avg([lcs_norm(p, r) for p, r in zip(preds_n, refs_n)]),
+            "TF-IDF": avg(tfidf_cosine_batch(preds_n, refs_n)),
+        })
+
+    base = next((r for r in rows if r["precision"] == "fp32"), rows[0])
+    out_csv = adir / "precision_compare.csv"
+    with open(out_csv, "w", newline="", encoding="utf-8") as wf:
+        w = csv.writer(wf)
+        w.writerow(["precision", "tokens_per_s", "peak_rss_mb", "Overlap", "LCS", "TF-IDF",
+                    "d_Overlap", "d_LCS", "d_TF-IDF"])
+        print("==================================================")
+        print(f"{'precision':<13} {'tok/s':>8} {'RSS MB':>8} {'Overlap':>8} {'LCS':>8} {'TF-IDF':>8}   Δ vs {base['precision']}")
+        for r in rows:
+            d = [r[k] - base[k] for k in ("Overlap", "LCS", "TF-IDF")]
+            w.writerow([r["precision"], f"{r['tokens_per_s']:.2f}", f"{r['peak_rss_mb']:.0f}",
+                        f"{r['Overlap']:.4f}", f"{r['LCS']:.4f}", f"{r['TF-IDF']:.4f}",
+                        f"{d[0]:+.4f}", f"{d[1]:+.4f}", f"{d[2]:+.4f}"])
+            print(f"{r['precision']:<13} {r['tokens_per_s']:>8.1f} {r['peak_rss_mb']:>8.0f} "
+                  f"{r['Overlap']:>8.4f} {r['LCS']:>8.4f} {r['TF-IDF']:>8.4f}   "
+                  f"{d[0]:+.4f} / {d[1]:+.4f} / {d[2]:+.4f}")
+    print(f"✅ wrote {out_csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# Benchmark: LoRA training throughput vs number of gloo DDP processes (train_lora_min.py --nproc N)
+# Each run keeps the per-process batch fixed, so N processes see N× the rows per step (weak scaling).
+# Run (from Code/):
+#   python training_code/bench_train_scaling.py --train_file ./sft_empathyagent_mini.jsonl --nprocs 1 2 4 8 \
+#          --max_steps 20 --batch_size 4 --pack
+from pathlib import Path
+import sys, argparse, csv, subprocess
+
+THIS_DIR = Path(__file__).resolve().parent
+CODE_DIR = THIS_DIR.parent
+sys.path.insert(0, str(CODE_DIR))
+import cfg_paths as P
+
+
+def last_throughput_row() -> dict:
+    with open(P.OUTPUT_DIR / "train_throughput.csv", newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))[-1]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--base_model", default="TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+    ap.add_argument("--train_file", default=str((P.CODE_DIR / "sft_empathyagent_mini.jsonl").resolve()))
+    ap.add_argument("--nprocs", type=int, nargs="+", default=[1, 2, 4, 8])
+    ap.add_argument("--max_steps", type=int, default=20)
+    ap.add_argument("--batch_size", type=int, default=4)
+    ap.add_argument("--max_length", type=int, default=768)
+    ap.add_argument("--pack", action="store_true")
+    args = ap.parse_args()
+
+    rows = []
+    for n in args.nprocs:
+        cmd = [sys.executable, str(THIS_DIR / "train_lora_min.py"), "--base_model", args.base_model,
+               "--train_file", args.train_file, "--output_name", f"bench_ddp_np{n}",
+               "--max_steps", str(args.max_steps), "--batch_size", str(args.batch_size),
+               "--max_length", str(args.max_length), "--nproc", str(n)]
+        if args.pack:
+            cmd.append("--pack")
+        print(f"[bench] nproc={n}: {' '.join(cmd[1:])}")
+        subprocess.run(cmd, check=True)
+        tp = last_throughput_row()
+        rows.append({"processes": n, "threads_per_process": int(tp["threads_per_process"]),
+                     "seconds": float(tp["seconds"]), "tokens_per_s": float(tp["real_tokens_per_s"])})
+
+    base = rows[0]["tokens_per_s"] / rows[0]["processes"]
+    out_csv = P.OUTPUT_DIR / "train_scaling.csv"
+    with open(out_csv, "w", newline="", encoding="utf-8") as wf:
+        w = csv.writer(wf)
+        w.writerow(["processes", "threads_per_process", "seconds", "real_tokens_per_s", "speedup", "efficiency"])
+        print("==================================================")
+        print(f"{'procs':>5} {'threads':>8} {'seconds':>8} {'tok/s':>9} {'speedup':>8} {'eff.':>6}")
+        for r in rows:
+            speedup = r["tokens_per_s"] / rows[0]["tokens_per_s"]
+            eff = r["tokens_per_s"] / (base * r["processes"])
+            w.writerow([r["processes"], r["threads_per_process"], f"{r['seconds']:.2f}",
+                        f"{r['tokens_per_s']:.2f}", f"{speedup:.2f}", f"{eff:.2f}"])
+            print(f"{r['processes']:>5} {r['threads_per_process']:>8} {r['seconds']:>8.1f} "
+                  f"{r['tokens_per_s']:>9.1f} {speedup:>7.2f}x {100 * eff:>5.0f}%")
+    print(f"✅ wrote {out_csv}")
+
+
+if __name__ == "__main__":
+    main()
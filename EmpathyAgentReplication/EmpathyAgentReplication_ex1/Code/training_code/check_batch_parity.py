@@ -0,0 +1,71 @@
+# Check: greedy outputs of batched generation (--batch_size N, length-bucketed, left-padded; --prefix_cache adds
+# the shared-prefix KV) vs one prompt at a time, the default path of infer_lora_min.py.
+# Reports identical rows, where mismatching rows first diverge, and tokens/sec of both paths.
+# Run (from Code/):
+#   python training_code/check_batch_parity.py --adapter_name lora_tinyllama_min \
+#          --prompts_file ./test_prompts.jsonl --batch_size 8 --max_new_tokens 160
+from pathlib import Path
+import sys, argparse, time
+from types import SimpleNamespace
+
+THIS_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(THIS_DIR))
+from infer_lora_min import (P, PRECISIONS, read_prompts, load_model, gen_kwargs_from_args, generate_batch,
+                            length_buckets, common_prefix_len, build_prefix_cache)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--base_model", default="TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+    ap.add_argument("--adapter_name", default="lora_tinyllama_min")
+    ap.add_argument("--prompts_file", required=True)
+    ap.add_argument("--n_prompts", type=int, default=0, help="First N prompts only (0 = all).")
+    ap.add_argument("--batch_size", type=int, default=8)
+    ap.add_argument("--max_new_tokens", type=int, default=160)
+    ap.add_argument("--precision", choices=PRECISIONS, default="fp32")
+    ap.add_argument("--prefix_cache", action="store_true",
+                    help="Batched path also starts from the prefilled shared-prefix KV (infer_lora_min.py --prefix_cache).")
+    args = ap.parse_args()
+
+    adapter_dir = P.OUTPUT_DIR / args.adapter_name
+    if not adapter_dir.exists():
+        raise FileNotFoundError(f"Adapter not found: {adapter_dir}")
+    prompts = read_prompts(args.prompts_file)
+    prompts = prompts[:args.n_prompts] if args.n_prompts else prompts
+    tok, model = load_model(args.base_model, adapter_dir, precision=args.precision)
+    gen_kwargs = gen_kwargs_from_args(tok, SimpleNamespace(max_new_tokens=args.max_new_tokens,
+                                                           temperature=0.0, greedy=True))
+
+    single, single_stats = [], {}
+    t0 = time.perf_counter()
+    for p in prompts:
+        single += generate_batch(tok, model, [p], gen_kwargs, single_stats)
+    t_single = time.perf_counter() - t0
+
+    batched, batched_stats = [None] * len(prompts), {}
+    row_ids = tok(prompts)["input_ids"]
+    t0 = time.perf_counter()
+    k = common_prefix_len(row_ids) if args.prefix_cache else 0
+    prefix = build_prefix_cache(model, row_ids[0][:k]) if k else None
+    for idxs in length_buckets([len(ids) for ids in row_ids], args.batch_size):
+        for i, out in zip(idxs, generate_batch(tok, model, [prompts[i] for i in idxs], gen_kwargs, batched_stats,
+                                               prefix)):
+            batched[i] = out
+    t_batched = time.perf_counter() - t0
+
+    same = [i for i, (a, b) in enumerate(zip(single, batched)) if a == b]
+    print("==================================================")
+    print(f"prompts: {len(prompts)} | batch_size: {args.batch_size} | max_new_tokens: {args.max_new_tokens} | "
+          f"{args.precision} | shared prefix: {k} tokens")
+    label = f"batch {args.batch_size}" + (" + prefix KV" if k else "")
+    print(f"{'batch 1':<22}: {t_single:.1f}s ({single_stats['new_tokens'] / t_single:.1f} tok/s)")
+    print(f"{label:<22}: {t_batched:.1f}s ({batched_stats['new_tokens'] / t_batched:.1f} tok/s)")
+    print(f"identical outputs: {len(same)}/{len(prompts)} {'✅' if len(same) == len(prompts) else '⚠️'}")
+    for i in (i for i in range(len(prompts)) if i not in set(same)):
+        a, b = single[i], batched[i]
+        c = next((j for j, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+        print(f"  row {i}: diverges at char {c}: {a[c:c + 40]!r} vs {b[c:c + 40]!r}")
+
+
+if __name__ == "__main__":
+    main()
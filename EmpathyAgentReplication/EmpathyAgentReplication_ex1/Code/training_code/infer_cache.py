@@ -0,0 +1,46 @@
+# Content-addressed generation cache for infer_lora_min.py (output/<adapter>/gen_cache.jsonl)
+# A row's key hashes the prompt with everything else that decides its output (run_fingerprint),
+# so retraining the adapter or changing the decoding never serves a stale row.
+from pathlib import Path
+import json, hashlib
+
+
+def adapter_checksum(adapter_dir: Path) -> str:
+    """sha256 over adapter_config.json + adapter_model.* (so retraining in place changes the key)."""
+    h = hashlib.sha256()
+    for p in sorted(adapter_dir.glob("adapter_*")):
+        if not p.is_file():
+            continue
+        h.update(p.name.encode("utf-8"))
+        with open(p, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def run_fingerprint(base_model: str, adapter_dir: Path, gen_kwargs: dict, load_kwargs: dict,
+                    **extra) -> str:
+    """Everything besides the prompt that decides the output: base, adapter weights, load mode, decoding."""
+    return json.dumps({"base_model": base_model,
+                       "adapter": adapter_checksum(adapter_dir),
+                       "load": load_kwargs,
+                       "gen": gen_kwargs, **extra}, sort_keys=True)
+
+
+def cache_key(fingerprint: str, prompt: str) -> str:
+    return hashlib.sha256((fingerprint + "\x00" + prompt).encode("utf-8")).hexdigest()
+
+
+def load_cache(cache_path: Path) -> dict:
+    """gen_cache.jsonl → {key: row}. Later lines win; a torn last line (killed run) is skipped."""
+    cache = {}
+    if not cache_path.exists():
+        return cache
+    with open(cache_path, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            cache[row.pop("key")] = row
+    return cache
@@ -1,117 +1,836 @@
 # Minimal LoRA inference on CPU (Python 3.9 compatible) with --greedy support
 from pathlib import Path
-from typing import Optional
-import sys, argparse, json
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from peft import PeftModel
+from typing import List, Optional
+import sys, argparse, json, hashlib, csv, time, shutil, resource
+# torch / transformers / peft are imported inside the functions that use them: they cost seconds,
+# and --help, argument errors and fully cached runs never touch a model.
 
 # make Code/ importable (so cfg_paths.py is found)
 THIS_DIR = Path(__file__).resolve().parent
 CODE_DIR = THIS_DIR.parent
 sys.path.insert(0, str(CODE_DIR))
 import cfg_paths as P  # uses OUTPUT_DIR where the adapter was saved
+# the generation cache, the --workers pool and --sweep live next to this file; infer_workers and infer_sweep
+# import from this module, so those two are imported where they are used
+from infer_cache import adapter_checksum, run_fingerprint, cache_key, load_cache
 
 
-def load_model(base_model: str, adapter_dir: Path):
-    tok = AutoTokenizer.from_pretrained(base_model, use_fast=True)
+def load_tokenizer(base_model: str, adapter_dir: Optional[Path] = None):
+    """The copy train_lora_min.py saved next to the adapter (local files, no hub lookup), else the base one."""
+    from transformers import AutoTokenizer
+    src = base_model
+    # tokenizer_config.json alone is not enough: without the vocab files AutoTokenizer cannot build it
+    if adapter_dir is not None and (adapter_dir / "tokenizer_config.json").exists() and any(
+            (adapter_dir / f).exists() for f in ("tokenizer.json", "tokenizer.model", "vocab.json")):
+        src = str(adapter_dir)
+    tok = AutoTokenizer.from_pretrained(src, use_fast=True)
     if tok.pad_token is None:
         tok.pad_token = tok.eos_token
-    base = AutoModelForCausalLM.from_pretrained(base_model)
-    model = PeftModel.from_pretrained(base, str(adapter_dir))
+    # decoder-only batches must be left-padded so every row continues from its own last token
+    tok.padding_side = "left"
+    return tok
+
+
+def merged_dir_for(base_model: str, adapter_dir: Path) -> Path:
+    """OUTPUT_DIR/<adapter>/merged/<hash of base name + adapter checksum>/"""
+    key = hashlib.sha256(f"{base_model}\x00{adapter_checksum(adapter_dir)}".encode("utf-8")).hexdigest()[:16]
+    return adapter_dir / "merged" / key
+
+
+def build_merged(base_model: str, adapter_dir: Path):
+    """
+    Fold the LoRA deltas into the base Linear weights (W += B·A·alpha/r) and save the result
+    as safetensors, replacing any merged copy of an older adapter checksum.
+    """
+    from transformers import AutoModelForCausalLM
+    from peft import PeftModel
+    out_dir = merged_dir_for(base_model, adapter_dir)
+    base = AutoModelForCausalLM.from_pretrained(base_model, low_cpu_mem_usage=True)
+    model = PeftModel.from_pretrained(base, str(adapter_dir)).merge_and_unload()
+    model.save_pretrained(str(out_dir), safe_serialization=True)
+    with open(out_dir / "merge_info.json", "w", encoding="utf-8") as f:
+        json.dump({"base_model": base_model, "adapter_dir": str(adapter_dir),
+                   "adapter_checksum": adapter_checksum(adapter_dir)}, f, indent=2)
+    for old in out_dir.parent.iterdir():
+        if old.is_dir() and old != out_dir:
+            shutil.rmtree(old)  # stale merge of a previous adapter version (~4.4 GB each)
+    print(f"[merge] saved merged checkpoint → {out_dir}")
+    return model
+
+
+PRECISIONS = ("fp32", "bf16", "int8-dynamic")
+
+
+def load_model(base_model: str, adapter_dir: Path, merged: bool = False, precision: str = "fp32", tok=None):
+    """
+    merged=False: base + PeftModel wrapper (LoRA matmuls run beside every target Linear).
+    merged=True : plain causal LM with the adapter folded in, cached under adapter_dir/merged/.
+    precision   : fp32 | bf16 (weights stored in bf16, ~half the RSS)
+                  | int8-dynamic (fp32 load, then torch dynamic int8 quantization of the nn.Linear
+                    layers; LoRA A/B of an attached adapter stay fp32, see quantize_int8_dynamic).
+    tok         : an already loaded tokenizer to return instead of loading it again.
+    Weights are created empty and filled straight from the memory-mapped safetensors
+    (low_cpu_mem_usage), not randomly initialised in fp32 first and then overwritten.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}; choose from {PRECISIONS}")
+    import torch
+    from transformers import AutoModelForCausalLM
+    from peft import PeftModel
+    if tok is None:
+        tok = load_tokenizer(base_model, adapter_dir)
+    dtype = torch.bfloat16 if precision == "bf16" else torch.float32
+    if merged:
+        mdir = merged_dir_for(base_model, adapter_dir)
+        if (mdir / "merge_info.json").exists():
+            model = AutoModelForCausalLM.from_pretrained(str(mdir), torch_dtype=dtype, low_cpu_mem_usage=True)
+        else:
+            model = build_merged(base_model, adapter_dir).to(dtype)
+    else:
+        base = AutoModelForCausalLM.from_pretrained(base_model, torch_dtype=dtype, low_cpu_mem_usage=True)
+        model = PeftModel.from_pretrained(base, str(adapter_dir))
     model.eval()
+    if precision == "int8-dynamic":
+        model = quantize_int8_dynamic(model)
     return tok, model
 
 
+def quantize_int8_dynamic(model):
+    """
+    Dynamic int8 for every nn.Linear except PEFT's lora_A/lora_B: a quantized Linear's .weight is a
+    method, and the LoRA forward casts its input to lora_A.weight.dtype. So an attached adapter keeps
+    fp32 LoRA matmuls beside int8 base_layers; with --merged the folded weights are all int8.
+    """
+    import torch
+    names = {name for name, mod in model.named_modules()
+             if isinstance(mod, torch.nn.Linear) and ".lora_" not in f".{name}"}
+    return torch.ao.quantization.quantize_dynamic(model, names, dtype=torch.qint8)
+
+
+def peak_rss_mb(children: bool = False) -> float:
+    """Peak resident set size of this process (or of its largest finished child)."""
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is bytes on macOS, KiB on Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def percentile(xs: List[float], q: float) -> float:
+    """Nearest-rank percentile (q in 0..100); 0.0 for an empty list."""
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(round(q / 100 * (len(xs) - 1))))]
+
+
 def fmt(instr: str, inp: Optional[str] = None):
     if inp:
         return f"### Instruction:\n{instr}\n\n### Input:\n{inp}\n\n### Response:\n"
     return f"### Instruction:\n{instr}\n\n### Response:\n"
 
 
+def read_prompts(prompts_file: str) -> List[str]:
+    """JSONL with {instruction|prompt, input?} → list of formatted prompts (file order)."""
+    prompts = []
+    with open(prompts_file, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            prompts.append(fmt(row.get("instruction") or row.get("prompt") or "Respond empathetically.",
+                               row.get("input")))
+    return prompts
+
+
+# The model tends to finish its answer and open the next fmt() block; anything after that is waste.
+RESPONSE_STOPS = ["### Instruction:", "### Input:", "### Response:"]
+
+
+def gen_kwargs_from_args(tok, args) -> dict:
+    # Greedy if --greedy or temperature <= 0; else sampling
+    use_sampling = (not args.greedy) and (args.temperature is not None and args.temperature > 0)
+
+    gen_kwargs = dict(
+        max_new_tokens=args.max_new_tokens,
+        do_sample=use_sampling,
+        pad_token_id=tok.eos_token_id,
+    )
+    if not getattr(args, "no_stop", False):
+        # per-row: a finished row is padded while the rest of the batch keeps going (EOS works the same)
+        gen_kwargs.update(stop_strings=RESPONSE_STOPS)
+    if use_sampling:
+        gen_kwargs.update(
+            temperature=args.temperature,
+            top_p=getattr(args, "top_p", 0.95),
+            repetition_penalty=1.1,
+        )
+    else:
+        # deterministic greedy
+        gen_kwargs.update(num_beams=1)
+    return gen_kwargs
+
+
+def trim_at_stop(text: str, stops: List[str]) -> str:
+    cut = min((i for i in (text.find(st) for st in stops) if i >= 0), default=len(text))
+    return text[:cut].rstrip()
+
+
+def generate_batch(tok, model, prompts: List[str], gen_kwargs: dict,
+                   stats: Optional[dict] = None, prefix: Optional[tuple] = None,
+                   echo_prompt: bool = False, assist: Optional[dict] = None,
+                   adapter_names: Optional[List[str]] = None) -> List[str]:
+    """
+    One model.generate call over a left-padded batch; returns decoded responses in input order
+    (only the new tokens, cut at the template boundary; echo_prompt=True keeps the old
+    prompt+completion text).
+    If `stats` is given, stats["new_tokens"] is increased by the non-pad tokens generated and
+    stats["row_tokens"] is set to the per-row counts for this call.
+    If `prefix` (from build_prefix_cache) is given and every prompt starts with it, generation
+    resumes from the cached prefix KV instead of re-running the prefix through the model.
+    If `assist` (from load_assist) is given, rows are decoded one by one with assisted generation.
+    If `adapter_names` is given (one per prompt), a multi-adapter PeftModel runs each row with its own LoRA.
+    """
+    if assist is not None:
+        return _generate_assisted(tok, model, prompts, gen_kwargs, stats, echo_prompt, assist)
+    if prefix is not None:
+        inputs = _inputs_after_prefix(tok, prompts, prefix)
+    else:
+        inputs = None
+    if inputs is None:
+        inputs = tok(prompts, return_tensors="pt", padding=True)
+    return generate_from_inputs(tok, model, inputs, gen_kwargs, stats, echo_prompt, adapter_names)
+
+
+def generate_from_inputs(tok, model, inputs: dict, gen_kwargs: dict, stats: Optional[dict] = None,
+                         echo_prompt: bool = False, adapter_names: Optional[List[str]] = None) -> List[str]:
+    """
+    generate_batch() after tokenization: `inputs` may already carry past_key_values.
+    With `stats`, also sets stats["row_metrics"]: per-row timing from hooks on the model's forward
+    (the first forward is the prefill; the second one starts once the first token is sampled).
+    """
+    import torch
+    extra = {"tokenizer": tok} if "stop_strings" in gen_kwargs else {}
+    if adapter_names is not None:
+        extra["adapter_names"] = adapter_names
+    starts, ends, hooks = [], [], []
+    if stats is not None:
+        target = model.get_base_model() if hasattr(model, "get_base_model") else model
+        hooks = [target.register_forward_pre_hook(lambda *_: starts.append(time.perf_counter())),
+                 target.register_forward_hook(lambda *_: ends.append(time.perf_counter()))]
+    t0 = time.perf_counter()
+    try:
+        with torch.no_grad():
+            out_ids = model.generate(**inputs, **gen_kwargs, **extra)
+    finally:
+        for h in hooks:
+            h.remove()
+    latency = time.perf_counter() - t0
+    new_ids = out_ids[:, inputs["input_ids"].shape[1]:]
+    if stats is not None:
+        row_tokens = (new_ids != tok.pad_token_id).sum(dim=1).tolist()
+        stats["row_tokens"] = row_tokens
+        stats["new_tokens"] = stats.get("new_tokens", 0) + sum(row_tokens)
+        prefill = (ends[0] - starts[0]) if ends else latency
+        ttft = (starts[1] - t0) if len(starts) > 1 else latency
+        rss = peak_rss_mb()
+        stats["row_metrics"] = [
+            {"prompt_tokens": int(n), "gen_tokens": int(g), "batch_size": len(row_tokens),
+             "prefill_s": round(prefill, 4), "ttft_s": round(ttft, 4), "latency_s": round(latency, 4),
+             "decode_tok_s": round((g - 1) / (latency - ttft), 2) if g > 1 and latency > ttft else None,
+             "peak_rss_mb": round(rss)}
+            for n, g in zip(inputs["attention_mask"].sum(dim=1).tolist(), row_tokens)]
+    # pad == eos, so skip_special_tokens drops the padding as well
+    if echo_prompt:
+        return [tok.decode(ids, skip_special_tokens=True) for ids in out_ids]
+    stops = gen_kwargs.get("stop_strings") or []
+    return [trim_at_stop(tok.decode(ids, skip_special_tokens=True), stops) for ids in new_ids]
+
+
+def load_assist(draft_model: str, tok, num_draft_tokens: int, precision: str = "fp32") -> dict:
+    """
+    Extra generate() kwargs for assisted (speculative) greedy decoding:
+      "prompt_lookup" → n-gram drafts copied from the prompt itself (no second model)
+      anything else   → a small causal LM that must share the target tokenizer
+    The target verifies every drafted token, so greedy output is unchanged.
+    """
+    if draft_model == "prompt_lookup":
+        return {"prompt_lookup_num_tokens": num_draft_tokens}
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    draft_tok = AutoTokenizer.from_pretrained(draft_model, use_fast=True)
+    if draft_tok.get_vocab() != tok.get_vocab():
+        raise ValueError(f"Draft model {draft_model} does not share the target tokenizer")
+    dtype = torch.bfloat16 if precision == "bf16" else torch.float32
+    draft = AutoModelForCausalLM.from_pretrained(draft_model, torch_dtype=dtype, low_cpu_mem_usage=True)
+    draft.eval()
+    draft.generation_config.num_assistant_tokens = num_draft_tokens
+    return {"assistant_model": draft}
+
+
+def _count_forwards(module, counter: dict, key: str):
+    def hook(*_):
+        counter[key] = counter.get(key, 0) + 1
+    return module.register_forward_hook(hook)
+
+
+def _generate_assisted(tok, model, prompts: List[str], gen_kwargs: dict, stats: Optional[dict],
+                       echo_prompt: bool, assist: dict) -> List[str]:
+    """
+    HF assisted generation only runs at batch size 1, so rows go one at a time. Forward passes of
+    the target (and of the draft model, if any) are counted to derive tokens/forward and acceptance:
+    each verification pass emits (accepted drafts + 1) tokens, so accepted = new_tokens - target passes.
+    """
+    counts = {}
+    target = model.get_base_model() if hasattr(model, "get_base_model") else model
+    hooks = [_count_forwards(target, counts, "target_forwards")]
+    if "assistant_model" in assist:
+        hooks.append(_count_forwards(assist["assistant_model"], counts, "draft_forwards"))
+    try:
+        texts, row_tokens, row_metrics = [], [], []
+        for prompt in prompts:
+            row_stats = {}
+            texts += generate_batch(tok, model, [prompt], {**gen_kwargs, **assist}, row_stats,
+                                    echo_prompt=echo_prompt)
+            row_tokens += row_stats["row_tokens"]
+            row_metrics += row_stats["row_metrics"]
+    finally:
+        for h in hooks:
+            h.remove()
+    if stats is not None:
+        stats["row_tokens"] = row_tokens
+        stats["row_metrics"] = row_metrics
+        stats["new_tokens"] = stats.get("new_tokens", 0) + sum(row_tokens)
+        for k, v in counts.items():
+            stats[k] = stats.get(k, 0) + v
+    return texts
+
+
+def assist_summary(stats: dict) -> str:
+    fwd = stats.get("target_forwards", 0)
+    toks = stats.get("new_tokens", 0)
+    accepted = toks - fwd
+    msg = f"{toks} tokens from {fwd} target forward passes ({toks / max(1, fwd):.2f} tokens/pass)"
+    if stats.get("draft_forwards"):
+        msg += f"; draft acceptance {accepted}/{stats['draft_forwards']} ({100 * accepted / stats['draft_forwards']:.1f}%)"
+    return msg
+
+
+def common_prefix_len(id_lists: List[List[int]]) -> int:
+    """Longest common token prefix, capped so every row keeps >= 1 token for generate() to feed."""
+    if not id_lists:
+        return 0
+    first, k = id_lists[0], min(len(ids) for ids in id_lists) - 1
+    for ids in id_lists[1:]:
+        j = 0
+        while j < k and ids[j] == first[j]:
+            j += 1
+        k = j
+    return max(0, k)
+
+
+def build_prefix_cache(model, prefix_ids: List[int]) -> tuple:
+    """Run the shared prefix once (batch 1) → (prefix_ids, legacy past_key_values)."""
+    import torch
+    with torch.no_grad():
+        out = model(input_ids=torch.tensor([prefix_ids]), use_cache=True)
+    pkv = out.past_key_values
+    if hasattr(pkv, "to_legacy_cache"):
+        pkv = pkv.to_legacy_cache()
+    return list(prefix_ids), pkv
+
+
+def _inputs_after_prefix(tok, prompts: List[str], prefix: tuple) -> Optional[dict]:
+    """
+    Lay rows out as [prefix][pad…][suffix]: the padding sits *between* the shared prefix and each
+    row's own suffix, so the prefix occupies positions 0..k-1 in every row and its cached KV is
+    valid for all of them (position_ids come from attention_mask.cumsum, which skips the pads).
+    Returns None if some prompt does not start with the prefix tokens.
+    """
+    import torch
+    from transformers import DynamicCache
+    prefix_ids, legacy = prefix
+    k = len(prefix_ids)
+    id_lists = tok(prompts)["input_ids"]
+    if any(ids[:k] != prefix_ids or len(ids) <= k for ids in id_lists):
+        return None
+    suffixes = [ids[k:] for ids in id_lists]
+    width = max(len(sfx) for sfx in suffixes)
+    rows, mask = [], []
+    for sfx in suffixes:
+        gap = width - len(sfx)
+        rows.append(prefix_ids + [tok.pad_token_id] * gap + sfx)
+        mask.append([1] * k + [0] * gap + [1] * len(sfx))
+    b = len(prompts)
+    # generate() appends to the cache in place, so every call gets its own batch-expanded copy
+    cache = DynamicCache.from_legacy_cache(tuple(
+        (key.expand(b, -1, -1, -1).contiguous(), val.expand(b, -1, -1, -1).contiguous())
+        for key, val in legacy))
+    return {"input_ids": torch.tensor(rows), "attention_mask": torch.tensor(mask), "past_key_values": cache}
+
+
+def length_buckets(lengths: List[int], batch_size: int) -> List[List[int]]:
+    """
+    Group prompt indices into batches of similar token length (sorted, then chunked),
+    so each batch pads only up to its own longest row.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    return [order[i:i + batch_size] for i in range(0, len(order), max(1, batch_size))]
+
+
+def log_throughput(adapter_name: str, rows: int, new_tokens: int, seconds: float,
+                   workers: int, threads: int, batch_size: int, precision: str, rss_mb: float):
+    """Append one row to OUTPUT_DIR/infer_throughput.csv (same spirit as run_log.csv)."""
+    log = P.OUTPUT_DIR / "infer_throughput.csv"
+    header = ["adapter", "rows", "new_tokens", "seconds", "tokens_per_s", "workers", "threads_per_worker",
+              "batch_size", "precision", "peak_rss_mb"]
+    exists = log.exists()
+    with open(log, "a", newline="", encoding="utf-8") as wf:
+        w = csv.writer(wf)
+        if not exists: w.writerow(header)
+        w.writerow([adapter_name, rows, new_tokens, f"{seconds:.2f}", f"{new_tokens / seconds:.2f}",
+                    workers, threads, batch_size, precision, f"{rss_mb:.0f}"])
+    print(f"[throughput] {new_tokens} tokens in {seconds:.1f}s → {new_tokens / seconds:.1f} tok/s "
+          f"(workers={workers}, threads/worker={threads}, {precision}, peak RSS/process {rss_mb:.0f} MB) "
+          f"| appended to {log}")
+
+
+def last_throughput_row() -> dict:
+    """The row log_throughput() appended last (bench scripts read it after running this file as a subprocess)."""
+    with open(P.OUTPUT_DIR / "infer_throughput.csv", newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))[-1]
+
+
+def sidecar_path(adapter_dir: Path, out_file: str, suffix: str) -> Path:
+    """inference.jsonl + "metrics.jsonl" → adapter_dir/inference_metrics.jsonl"""
+    return adapter_dir / f"{Path(out_file).stem}_{suffix}"
+
+
+def metrics_summary(row_metrics: List[dict], new_tokens: int, seconds: float, **run) -> dict:
+    """Run summary over the per-row metrics of one work group (latency/TTFT percentiles, throughput)."""
+    lat = [m["latency_s"] for m in row_metrics]
+    ttft = [m["ttft_s"] for m in row_metrics]
+    return {"rows": len(row_metrics),
+            "prompt_tokens": sum(m["prompt_tokens"] for m in row_metrics),
+            "new_tokens": new_tokens,
+            "seconds": round(seconds, 2),
+            "tokens_per_s": round(new_tokens / max(seconds, 1e-9), 2),
+            "latency_s": {f"p{q}": round(percentile(lat, q), 3) for q in (50, 95, 99)},
+            "ttft_s": {f"p{q}": round(percentile(ttft, q), 3) for q in (50, 95, 99)},
+            **run}
+
+
+def start_trace():
+    import torch
+    prof = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], record_shapes=True)
+    prof.start()
+    return prof
+
+
+def finish_trace(prof, trace_path: Path, what: str):
+    prof.stop()
+    prof.export_chrome_trace(str(trace_path))
+    print(prof.key_averages().table(sort_by="self_cpu_time_total", row_limit=15))
+    print(f"[trace] {what} → {trace_path} (open in Perfetto or chrome://tracing)")
+
+
+def resolve_adapters(specs: List[str]) -> List[str]:
+    """--adapter_name values → adapter folder names; accepts a,b,c lists and globs under OUTPUT_DIR."""
+    names = []
+    for spec in specs:
+        for part in (x.strip() for x in spec.split(",")):
+            if any(ch in part for ch in "*?["):
+                names += sorted(p.name for p in P.OUTPUT_DIR.glob(part) if (p / "adapter_config.json").exists())
+            elif part:
+                names.append(part)
+    return list(dict.fromkeys(names))  # de-dupe, keep order
+
+
+def _peft_name(adapter_name: str) -> str:
+    # PEFT registers adapters as ModuleDict keys, which may not contain "."
+    return adapter_name.replace(".", "_")
+
+
+def load_multi_adapter_model(base_model: str, adapter_names: List[str], precision: str = "fp32", tok=None):
+    """One base model with every adapter attached under its folder name (switch via set_adapter)."""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}; choose from {PRECISIONS}")
+    import torch
+    from transformers import AutoModelForCausalLM
+    from peft import PeftModel
+    first, rest = adapter_names[0], adapter_names[1:]
+    if tok is None:
+        tok = load_tokenizer(base_model, P.OUTPUT_DIR / first)
+    dtype = torch.bfloat16 if precision == "bf16" else torch.float32
+    base = AutoModelForCausalLM.from_pretrained(base_model, torch_dtype=dtype, low_cpu_mem_usage=True)
+    model = PeftModel.from_pretrained(base, str(P.OUTPUT_DIR / first), adapter_name=_peft_name(first))
+    for name in rest:
+        model.load_adapter(str(P.OUTPUT_DIR / name), adapter_name=_peft_name(name))
+    model.eval()
+    if precision == "int8-dynamic":
+        model = quantize_int8_dynamic(model)
+    print(f"[adapters] base loaded once with {len(adapter_names)} adapters: {', '.join(adapter_names)}")
+    return tok, model
+
+
+class LocalEngine:
+    """
+    In-process generation behind one generate() call: loads the model lazily (so a fully cached
+    run never pays for it), keeps the shared-prefix KV and the draft model, and switches the
+    active adapter when several are attached.
+    """
+
+    def __init__(self, args, tok, gen_kwargs: dict, load_kwargs: dict, adapters: List[str]):
+        self.args, self.tok, self.gen_kwargs, self.load_kwargs = args, tok, gen_kwargs, load_kwargs
+        self.adapters = adapters
+        self.model = None
+        self.active = adapters[0]
+        self.prefix_ids, self.prefix = [], None
+        self.assist = None
+
+    def ensure_model(self):
+        if self.model is not None:
+            return
+        if len(self.adapters) == 1:
+            _, self.model = load_model(self.args.base_model, P.OUTPUT_DIR / self.adapters[0],
+                                       tok=self.tok, **self.load_kwargs)
+        else:
+            _, self.model = load_multi_adapter_model(self.args.base_model, self.adapters,
+                                                     self.load_kwargs.get("precision", "fp32"), tok=self.tok)
+            self.model.set_adapter(_peft_name(self.active))
+        if self.args.draft_model:
+            self.assist = load_assist(self.args.draft_model, self.tok, self.args.num_draft_tokens,
+                                      self.args.precision)
+
+    def use_adapter(self, name: str):
+        if name != self.active:
+            self.active = name
+            self.prefix_ids, self.prefix = [], None  # the adapter changes K/V, so the prefix KV is stale
+            if self.model is not None:
+                self.model.set_adapter(_peft_name(name))
+
+    def set_prefix(self, prefix_ids: List[int]):
+        self.prefix_ids, self.prefix = list(prefix_ids), None
+
+    def generate(self, prompts: List[str], stats: Optional[dict] = None,
+                 adapter_names: Optional[List[str]] = None) -> List[str]:
+        self.ensure_model()
+        if adapter_names is not None:
+            # mixed-adapter batch: PEFT routes each row through its own LoRA weights
+            return generate_batch(self.tok, self.model, prompts, self.gen_kwargs, stats,
+                                  echo_prompt=self.args.echo_prompt,
+                                  adapter_names=[_peft_name(a) for a in adapter_names])
+        if self.prefix_ids and self.prefix is None:
+            self.prefix = build_prefix_cache(self.model, self.prefix_ids)
+        return generate_batch(self.tok, self.model, prompts, self.gen_kwargs, stats, self.prefix,
+                              self.args.echo_prompt, self.assist)
+
+
+def run_prompts_file(args, tok, gen_kwargs: dict, load_kwargs: dict, adapters: List[str], engine: LocalEngine):
+    """
+    --prompts_file mode for one or more adapters: cache lookup per adapter, length-bucketed batches
+    (per adapter, or pooled across adapters with --mix_adapters), one ordered output file per adapter.
+    Rows generated in this run also get a line in <out_file stem>_metrics.jsonl (see generate_from_inputs),
+    and each work group writes a latency/throughput summary to <out_file stem>_metrics_summary.json.
+    """
+    prompts = read_prompts(args.prompts_file)
+    total = len(prompts)
+
+    # Content-addressed cache: rows already generated with the same base/adapter/decoding
+    # are reused, so an interrupted run resumes and overlapping prompt sets are ~free.
+    # Only greedy rows are cached: a sampled row is a fresh draw on every run (and for every
+    # repeat of a prompt), so it is kept for this run only. Batch size and the prefix KV
+    # change fp32 numerics, so they are part of the key.
+    cacheable = not gen_kwargs["do_sample"]
+    prefix_cache = args.prefix_cache and not args.draft_model and not (args.mix_adapters and len(adapters) > 1)
+    if not cacheable:
+        print("[cache] sampling: rows are generated fresh and not cached (use --greedy to cache and resume)")
+    jobs = []
+    for name in adapters:
+        adapter_dir = P.OUTPUT_DIR / name
+        cache_path = adapter_dir / "gen_cache.jsonl"
+        if cacheable:
+            fingerprint = run_fingerprint(args.base_model, adapter_dir, gen_kwargs, load_kwargs,
+                                          echo_prompt=args.echo_prompt, batch_size=args.batch_size,
+                                          prefix_cache=prefix_cache)
+            keys = [cache_key(fingerprint, p) for p in prompts]
+        else:
+            keys = [f"row{i}" for i in range(total)]
+        cache = load_cache(cache_path) if cacheable and not args.refresh_cache else {}
+        todo, seen = [], set()
+        for i, k in enumerate(keys):
+            if k not in cache and k not in seen:
+                seen.add(k)
+                todo.append(i)
+        if cacheable:
+            print(f"[cache] {name}: {total - len(todo)}/{total} rows cached, {len(todo)} to generate → {cache_path}")
+        jobs.append({"name": name, "dir": adapter_dir, "keys": keys, "cache": cache, "todo": todo, "n": 0,
+                     "out_path": adapter_dir / args.out_file,
+                     "wf": open(adapter_dir / args.out_file, "w", encoding="utf-8"),
+                     "cf": open(cache_path, "a", encoding="utf-8") if cacheable else None,
+                     "mf": open(sidecar_path(adapter_dir, args.out_file, "metrics.jsonl"), "w", encoding="utf-8")})
+
+    # Rows are written back in file order as soon as every earlier row is done
+    # (so each output file still grows while you watch it).
+    def drain(job):
+        keys, cache, wf = job["keys"], job["cache"], job["wf"]
+        while job["n"] < total and keys[job["n"]] in cache:
+            row = cache[keys[job["n"]]]
+            json.dump({"prompt": prompts[job["n"]], "output": row["output"],
+                       "gen_tokens": row.get("gen_tokens")}, wf, ensure_ascii=False)
+            wf.write("\n")
+            job["n"] += 1
+        wf.flush()  # so you can watch file grow
+
+    # Work groups: one per adapter (so set_adapter and the prefix KV are reused), or one pooled
+    # group when rows from different adapters may share a batch.
+    if args.mix_adapters and len(jobs) > 1:
+        groups = [[(a, i) for a, job in enumerate(jobs) for i in job["todo"]]]
+    else:
+        groups = [[(a, i) for i in job["todo"]] for a, job in enumerate(jobs)]
+
+    try:
+        for job in jobs:
+            drain(job)
+        for rows in groups:
+            if not rows:
+                continue
+            mixed = len({a for a, _ in rows}) > 1
+            label = "+".join(jobs[a]["name"] for a in sorted({a for a, _ in rows}))
+            if not mixed:
+                engine.use_adapter(jobs[rows[0][0]]["name"])
+            row_ids = tok([prompts[i] for _, i in rows])["input_ids"]
+            buckets = [[rows[j] for j in b] for b in length_buckets([len(ids) for ids in row_ids], args.batch_size)]
+            workers = min(args.workers, len(buckets))
+
+            # Shared-prefix KV reuse: the fmt() scaffold (and, for scenario prompts, the whole
+            # instruction) is identical across rows, so prefill it once per process.
+            # (assisted decoding keeps its own per-row cache, and each adapter has its own K/V)
+            prefix_ids = []
+            k = common_prefix_len(row_ids) if (args.prefix_cache and not args.draft_model and not mixed) else 0
+            if k >= args.min_prefix_tokens:
+                prefix_ids = row_ids[0][:k]
+                engine.set_prefix(prefix_ids)
+                prefill_total = sum(len(ids) for ids in row_ids)
+                saved = k * (len(row_ids) - max(1, workers))
+                print(f"[prefix] {label}: {k} shared tokens; prefill tokens saved {saved}/{prefill_total} "
+                      f"({100 * saved / prefill_total:.1f}%)")
+
+            run_stats = {}
+            if workers > 1:
+                from infer_workers import iter_worker_results, core_slices
+                adapter_dir = jobs[0]["dir"]
+                if args.merged and not (merged_dir_for(args.base_model, adapter_dir) / "merge_info.json").exists():
+                    build_merged(args.base_model, adapter_dir)  # merge once here, not racily in every worker
+                opts = dict(prefix_ids=prefix_ids, echo_prompt=args.echo_prompt,
+                            draft_model=args.draft_model, num_draft_tokens=args.num_draft_tokens)
+                idx_buckets = [[i for _, i in b] for b in buckets]
+                results = (([(0, i) for i in idxs], gens, row_tokens, row_metrics)
+                           for idxs, gens, row_tokens, row_metrics in
+                           iter_worker_results(workers, args.base_model, adapter_dir, load_kwargs,
+                                               prompts, idx_buckets, gen_kwargs, opts, run_stats))
+                threads = len(core_slices(workers)[0])
+            else:
+                def local_results():
+                    for b in buckets:
+                        names = [jobs[a]["name"] for a, _ in b] if mixed else None
+                        gens = engine.generate([prompts[i] for _, i in b], run_stats, adapter_names=names)
+                        yield b, gens, run_stats["row_tokens"], run_stats["row_metrics"]
+
+                def traced(results, trace_path):
+                    # torch.profiler over the batches covering the first --trace_rows rows
+                    prof, rows_seen = start_trace(), 0
+                    for item in results:
+                        if prof is not None:
+                            rows_seen += len(item[0])
+                            if rows_seen >= args.trace_rows:
+                                finish_trace(prof, trace_path, f"first {rows_seen} rows")
+                                prof = None
+                        yield item
+                    if prof is not None:
+                        finish_trace(prof, trace_path, f"first {rows_seen} rows")
+                results = local_results()
+                if args.trace_rows:
+                    results = traced(results, sidecar_path(jobs[rows[0][0]]["dir"], args.out_file, "trace.json"))
+                import torch  # only runs that generate here pay for it; fully cached runs never get this far
+                threads = torch.get_num_threads()
+
+            t0 = time.perf_counter()
+            new_tokens = done = 0
+            group_metrics = []
+            for b, gens, row_tokens, row_metrics in results:
+                for (a, i), gen, ntok, m in zip(b, gens, row_tokens, row_metrics):
+                    job = jobs[a]
+                    job["cache"][job["keys"][i]] = {"output": gen, "gen_tokens": ntok}
+                    if job["cf"] is not None:
+                        json.dump({"key": job["keys"][i], "output": gen, "gen_tokens": ntok}, job["cf"],
+                                  ensure_ascii=False)
+                        job["cf"].write("\n")
+                    json.dump({"idx": i, **m}, job["mf"])
+                    job["mf"].write("\n")
+                group_metrics += row_metrics
+                for a in {a for a, _ in b}:
+                    if jobs[a]["cf"] is not None:
+                        jobs[a]["cf"].flush()
+                    jobs[a]["mf"].flush()
+                    drain(jobs[a])
+                done += len(b)
+                new_tokens += sum(row_tokens)
+                print(f"[infer] {label}: {done}/{len(rows)} generated")
+
+            budget = args.max_new_tokens * len(rows)
+            print(f"[stop] {new_tokens / len(rows):.1f} generated tokens/row on average; "
+                  f"{budget - new_tokens}/{budget} row-token slots ({100 * (budget - new_tokens) / budget:.1f}%) "
+                  f"not generated vs always running to --max_new_tokens")
+            if args.draft_model:
+                run_stats["new_tokens"] = new_tokens
+                print(f"[assist] {args.draft_model}: {assist_summary(run_stats)}")
+            seconds = time.perf_counter() - t0
+            rss = peak_rss_mb(children=workers > 1)
+            log_throughput(label, len(rows), new_tokens, seconds, max(1, workers), threads, args.batch_size,
+                           args.precision, rss)
+            summary = metrics_summary(group_metrics, new_tokens, seconds, adapters=label, workers=max(1, workers),
+                                      threads_per_worker=threads, batch_size=args.batch_size,
+                                      precision=args.precision, merged=args.merged, peak_rss_mb=round(rss))
+            for a in sorted({a for a, _ in rows}):
+                path = sidecar_path(jobs[a]["dir"], args.out_file, "metrics_summary.json")
+                with open(path, "w", encoding="utf-8") as f:
+                    json.dump(summary, f, indent=2)
+            print(f"[metrics] {label}: latency p50/p95/p99 "
+                  + "/".join(f"{v:.2f}" for v in summary["latency_s"].values())
+                  + "s | TTFT p50/p95/p99 " + "/".join(f"{v:.2f}" for v in summary["ttft_s"].values())
+                  + f"s | {summary['tokens_per_s']:.1f} tok/s → {path.name}")
+    finally:
+        for job in jobs:
+            job["wf"].close()
+            if job["cf"] is not None:
+                job["cf"].close()
+            job["mf"].close()
+
+    for job in jobs:
+        print(f"✅ wrote {job['n']} generations to {job['out_path']}")
+
+
+DEMO_PROMPT = fmt("You are an empathetic assistant. A teen is overwhelmed after a fight with a sibling. "
+                  "Offer a brief plan with 2 concrete, kind actions the caregiver can take right now.")
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--base_model", default="TinyLlama/TinyLlama-1.1B-Chat-v1.0")
-    ap.add_argument("--adapter_name", default="lora_tinyllama_min")
+    ap.add_argument("--adapter_name", nargs="+", default=["lora_tinyllama_min"],
+                    help="One or more adapter folders under OUTPUT_DIR (space/comma separated, globs allowed, "
+                         "e.g. 'lora_*'); the base model is loaded once and each adapter writes its own file.")
+    ap.add_argument("--mix_adapters", action="store_true",
+                    help="With several adapters, let rows of different adapters share a batch.")
     ap.add_argument("--prompt", default=None)        # single prompt string
     ap.add_argument("--prompts_file", default=None)  # optional JSONL with {instruction,input}
     ap.add_argument("--max_new_tokens", type=int, default=150)
     ap.add_argument("--temperature", type=float, default=0.7)
     ap.add_argument("--greedy", action="store_true",
                     help="Deterministic decoding (do_sample=False). Use this instead of temperature=0.")
+    ap.add_argument("--batch_size", type=int, default=1,
+                    help="Prompts per generate() call in --prompts_file mode. 1 = row by row (reference output); "
+                         ">1 is faster, but greedy tokens can differ on fp32 near-ties (see check_batch_parity.py).")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="Data-parallel processes for --prompts_file; each gets its own slice of cores.")
+    ap.add_argument("--merged", action="store_true",
+                    help="Fold the LoRA into the base weights once (cached under <adapter>/merged/) and decode "
+                         "with the plain model; logits match the PeftModel path within 1e-3 in fp32.")
+    ap.add_argument("--precision", choices=PRECISIONS, default="fp32",
+                    help="Weight precision on CPU; int8-dynamic quantizes the base Linear layers after merge/attach.")
+    ap.add_argument("--out_file", default="inference.jsonl",
+                    help="Output file name inside the adapter folder (e.g. to keep one file per precision).")
+    ap.add_argument("--prefix_cache", action="store_true",
+                    help="Reuse the KV of the token prefix shared by all prompts in --prompts_file. Faster, but "
+                         "the split prefill can change greedy tokens on fp32 near-ties (see check_batch_parity.py).")
+    ap.add_argument("--min_prefix_tokens", type=int, default=4,
+                    help="Only reuse a shared prefix at least this many tokens long.")
+    ap.add_argument("--no_stop", action="store_true",
+                    help="Always run to --max_new_tokens instead of stopping at EOS/the next '### ...' block.")
+    ap.add_argument("--echo_prompt", action="store_true",
+                    help="Write prompt+completion as 'output' (pre-stopping behaviour) instead of the response only.")
+    ap.add_argument("--draft_model", default=None,
+                    help="Assisted decoding for --greedy: a small causal LM sharing the tokenizer "
+                         "(e.g. JackFram/llama-68m) or 'prompt_lookup' for n-gram drafts from the prompt.")
+    ap.add_argument("--num_draft_tokens", type=int, default=10,
+                    help="Tokens proposed per draft step (prompt_lookup n-gram length / assistant lookahead).")
+    ap.add_argument("--refresh_cache", action="store_true",
+                    help="Ignore cached generations and regenerate every row (new results still get cached).")
+    ap.add_argument("--sweep", default=None,
+                    help="Decoding grid for --prompts_file, e.g. 'temperature=0.3,0.7,1.0;top_p=0.9,0.95;seed=0,1' "
+                         "or a .json file; prompts are prefilled once and every setting writes "
+                         "<out_file>_<tag>.jsonl.")
+    ap.add_argument("--profile_startup", "--profile-startup", action="store_true",
+                    help="Print import / tokenizer-load / weight-load / first-token timings before running.")
+    ap.add_argument("--trace_rows", type=int, default=0,
+                    help="Record a torch.profiler CPU trace over the batches covering the first K generated rows "
+                         "(written as <out_file stem>_trace.json; in-process runs only).")
     args = ap.parse_args()
 
-    # Paths & model
-    adapter_dir = P.OUTPUT_DIR / args.adapter_name
-    if not adapter_dir.exists():
-        raise FileNotFoundError(f"Adapter not found: {adapter_dir}")
-    tok, model = load_model(args.base_model, adapter_dir)
-
-    # Local helper (captures tok/model/args)
-    def generate_one(prompt: str) -> str:
-        inputs = tok(prompt, return_tensors="pt")
+    adapters = resolve_adapters(args.adapter_name)
+    if not adapters:
+        raise FileNotFoundError(f"No adapters match {args.adapter_name} under {P.OUTPUT_DIR}")
+    for name in adapters:
+        if not (P.OUTPUT_DIR / name).exists():
+            raise FileNotFoundError(f"Adapter not found: {P.OUTPUT_DIR / name}")
+    if len(adapters) > 1 and args.merged:
+        raise ValueError("--merged folds one adapter into the base; it cannot be combined with several adapters")
+    if len(adapters) > 1 and args.workers > 1:
+        raise ValueError("--workers shards a single adapter; run several adapters in one process instead")
+    if args.draft_model and not args.greedy:
+        raise ValueError("--draft_model only applies to --greedy decoding")
+    if args.mix_adapters and args.draft_model:
+        raise ValueError("--mix_adapters needs batched generate(); it cannot be combined with --draft_model")
+    if args.trace_rows and args.workers > 1:
+        raise ValueError("--trace_rows profiles this process; run it with --workers 1")
+    if args.sweep and not (args.prompts_file and len(adapters) == 1 and args.workers == 1 and not args.draft_model):
+        raise ValueError("--sweep runs one adapter over --prompts_file in this process (no --workers/--draft_model)")
 
-        # Greedy if --greedy or temperature <= 0; else sampling
-        use_sampling = (not args.greedy) and (args.temperature is not None and args.temperature > 0)
-
-        gen_kwargs = dict(
-            max_new_tokens=args.max_new_tokens,
-            do_sample=use_sampling,
-            pad_token_id=tok.eos_token_id,
-        )
-        if use_sampling:
-            gen_kwargs.update(
-                temperature=args.temperature,
-                top_p=0.95,
-                repetition_penalty=1.1,
-            )
+    # --profile_startup forces each cold-start stage here, in order, and times it on its own
+    # (otherwise imports and weights load lazily, on first use)
+    prof, t = {}, time.perf_counter()
+    if args.profile_startup:
+        import torch, transformers, peft  # noqa: F401
+        prof["imports"], t = time.perf_counter() - t, time.perf_counter()
+    tok = load_tokenizer(args.base_model, P.OUTPUT_DIR / adapters[0])
+    gen_kwargs = gen_kwargs_from_args(tok, args)
+    load_kwargs = dict(merged=args.merged, precision=args.precision)
+    engine = LocalEngine(args, tok, gen_kwargs, load_kwargs, adapters)
+    if args.profile_startup:
+        prof["tokenizer"], t = time.perf_counter() - t, time.perf_counter()
+        engine.ensure_model()
+        prof["weights"], t = time.perf_counter() - t, time.perf_counter()
+        if args.prompt:
+            first = args.prompt if "### Instruction" in args.prompt else fmt(args.prompt)
         else:
-            # deterministic greedy
-            gen_kwargs.update(num_beams=1)
-
-        with torch.no_grad():
-            out_ids = model.generate(**inputs, **gen_kwargs)
-        return tok.decode(out_ids[0], skip_special_tokens=True)
+            first = read_prompts(args.prompts_file)[0] if args.prompts_file else DEMO_PROMPT
+        generate_batch(tok, engine.model, [first], {**gen_kwargs, "max_new_tokens": 1})
+        prof["first token"] = time.perf_counter() - t
+        print("[startup] " + " | ".join(f"{k} {v:.2f}s" for k, v in prof.items())
+              + f" | total {sum(prof.values()):.2f}s | peak RSS {peak_rss_mb():.0f} MB")
 
     # Single prompt mode
     if args.prompt:
         prompt = args.prompt if "### Instruction" in args.prompt else fmt(args.prompt)
-        print(generate_one(prompt))
+        for name in adapters:
+            engine.use_adapter(name)
+            if len(adapters) > 1:
+                print(f"===== {name} =====")
+            print(engine.generate([prompt])[0])
         return
 
     # Batch mode from JSONL
+    if args.prompts_file and args.sweep:
+        from infer_sweep import run_sweep
+        run_sweep(args, tok, load_kwargs, engine)
+        return
     if args.prompts_file:
-        out_path = adapter_dir / "inference.jsonl"
-
-        # count total lines for nicer logs
-        with open(args.prompts_file, "r", encoding="utf-8", errors="ignore") as f:
-            total = sum(1 for line in f if line.strip())
-
-        n = 0
-        with open(args.prompts_file, "r", encoding="utf-8", errors="ignore") as f, \
-             open(out_path, "w", encoding="utf-8") as wf:
-            for line in f:
-                if not line.strip():
-                    continue
-                row = json.loads(line)
-                prompt = fmt(row.get("instruction") or row.get("prompt") or "Respond empathetically.",
-                             row.get("input"))
-                gen = generate_one(prompt)
-                json.dump({"prompt": prompt, "output": gen}, wf, ensure_ascii=False)
-                wf.write("\n")
-                wf.flush()  # so you can watch file grow
-
-                n += 1
-                if n % 5 == 0 or n == total:
-                    print(f"[infer] {n}/{total} done → {out_path}")
-
-        print(f"✅ wrote {n} generations to {out_path}")
+        run_prompts_file(args, tok, gen_kwargs, load_kwargs, adapters, engine)
         return
 
     # Default demo
-    demo = fmt("You are an empathetic assistant. A teen is overwhelmed after a fight with a sibling. "
-               "Offer a brief plan with 2 concrete, kind actions the caregiver can take right now.")
-    print(generate_one(demo))
+    engine.use_adapter(adapters[0])
+    print(engine.generate([DEMO_PROMPT])[0])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,179 @@
+# Decoding-parameter sweeps for infer_lora_min.py --sweep: every setting of a grid over one prompt file,
+# with each batch of prompts prefilled once and decoded per setting from its own copy of the KV.
+# parse_sweep/setting_tag are shared with sweep_train_lora.py.
+from pathlib import Path
+from typing import List
+import sys, argparse, json, hashlib, time, itertools
+
+THIS_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(THIS_DIR))
+from infer_lora_min import (P, read_prompts, gen_kwargs_from_args, generate_from_inputs, length_buckets,
+                            log_throughput, peak_rss_mb)
+from infer_cache import run_fingerprint, cache_key, load_cache
+
+
+def prefill_kv(model, inputs: dict) -> tuple:
+    """
+    Run a left-padded batch once through every prompt token but the last → legacy past_key_values.
+    position_ids follow generate() (attention_mask.cumsum), so the KV matches what generate() would build.
+    """
+    import torch
+    mask = inputs["attention_mask"]
+    pos = mask.long().cumsum(-1) - 1
+    pos.masked_fill_(mask == 0, 1)
+    with torch.no_grad():
+        out = model(input_ids=inputs["input_ids"][:, :-1], attention_mask=mask[:, :-1],
+                    position_ids=pos[:, :-1], use_cache=True)
+    pkv = out.past_key_values
+    if hasattr(pkv, "to_legacy_cache"):
+        pkv = pkv.to_legacy_cache()
+    return pkv
+
+
+def fork_kv(legacy: tuple) -> "DynamicCache":
+    from transformers import DynamicCache
+    # generate() appends to the cache in place, so each decoding setting gets its own copy
+    return DynamicCache.from_legacy_cache(tuple((k.clone(), v.clone()) for k, v in legacy))
+
+
+# --sweep keys → short tags for the per-setting output file names
+SWEEP_KEYS = {"temperature": "t", "top_p": "p", "seed": "s", "max_new_tokens": "n", "greedy": "greedy"}
+
+
+def _grid_value(v: str):
+    try:
+        return json.loads(v.lower())
+    except ValueError:
+        return v  # bare words, e.g. q_proj+v_proj
+
+
+def parse_sweep(spec: str, keys: dict = SWEEP_KEYS) -> List[dict]:
+    """
+    Decoding grid → list of settings. Either inline, the Cartesian product of
+      "temperature=0.3,0.7,1.0;top_p=0.9,0.95;seed=0,1"
+    or a .json file holding a list of setting dicts or a {key: [values]} grid.
+    `keys` maps the allowed keys to their short tags (see setting_tag).
+    """
+    if spec.endswith(".json"):
+        with open(spec, "r", encoding="utf-8") as f:
+            grid = json.load(f)
+        if isinstance(grid, list):
+            settings = grid
+        else:
+            settings = [dict(zip(grid, combo)) for combo in itertools.product(*grid.values())]
+    else:
+        grid = {}
+        for part in (x.strip() for x in spec.split(";")):
+            if part:
+                key, _, vals = part.partition("=")
+                grid[key.strip()] = [_grid_value(v.strip()) for v in vals.split(",") if v.strip()]
+        settings = [dict(zip(grid, combo)) for combo in itertools.product(*grid.values())]
+    for s in settings:
+        unknown = set(s) - set(keys)
+        if unknown:
+            raise ValueError(f"--sweep: unknown key(s) {sorted(unknown)}; use {sorted(keys)}")
+    if not settings:
+        raise ValueError(f"--sweep: no settings in {spec!r}")
+    return settings
+
+
+def setting_tag(setting: dict, keys: dict = SWEEP_KEYS) -> str:
+    parts = []
+    for k, v in setting.items():
+        if k == "greedy":
+            parts.append("greedy" if v else "sampled")
+        else:
+            parts.append(f"{keys[k]}{'+'.join(v) if isinstance(v, list) else v}")
+    return "_".join(parts)
+
+
+def row_seed(seed: int, prompt: str) -> int:
+    """A sampled sweep row's RNG seed: the setting's seed mixed with the prompt, independent of row order."""
+    return int(hashlib.sha256(f"{seed}\x00{prompt}".encode("utf-8")).hexdigest()[:8], 16)
+
+
+def run_sweep(args, tok, load_kwargs: dict, engine):
+    """
+    --sweep mode: every decoding setting over the same --prompts_file. Each length bucket is prefilled
+    once (all prompt tokens but the last) and every setting decodes from its own fork of that KV,
+    so prefill cost stays flat as settings are added. Writes <out_file stem>_<tag>.jsonl per setting.
+    `engine` is infer_lora_min's LocalEngine (model loaded on first use).
+    Greedy settings decode --batch_size rows at a time. Sampled settings decode one row at a time,
+    seeded with row_seed(), so a row's draw does not depend on which prompts share its batch.
+    """
+    import torch
+    prompts = read_prompts(args.prompts_file)
+    total = len(prompts)
+    name = engine.adapters[0]
+    adapter_dir = P.OUTPUT_DIR / name
+    cache_path = adapter_dir / "gen_cache.jsonl"
+    cache = {} if args.refresh_cache else load_cache(cache_path)
+
+    settings = []
+    for s in parse_sweep(args.sweep):
+        opts = argparse.Namespace(**{**vars(args), **s})
+        gk = gen_kwargs_from_args(tok, opts)
+        seed = s.get("seed", 0) if gk["do_sample"] else None
+        # prefill_kv + fork_kv is its own numeric path, so sweep rows never share cache rows with plain runs
+        extra = {"echo_prompt": args.echo_prompt, "sweep": "prefill_kv",
+                 "batch_size": args.batch_size if seed is None else 1}
+        if seed is not None:
+            extra["seed"] = seed
+        fingerprint = run_fingerprint(args.base_model, adapter_dir, gk, load_kwargs, **extra)
+        out = Path(args.out_file)
+        settings.append({"tag": setting_tag(s), "gen_kwargs": gk, "seed": seed, "batch_size": extra["batch_size"],
+                         "keys": [cache_key(fingerprint, p) for p in prompts],
+                         "out_path": adapter_dir / f"{out.stem}_{setting_tag(s)}{out.suffix}"})
+
+    todo = [i for i in range(total) if any(s["keys"][i] not in cache for s in settings)]
+    print(f"[sweep] {len(settings)} settings × {total} prompts; {len(todo)} prompts still need generating")
+
+    if todo:
+        engine.ensure_model()
+        t0 = time.perf_counter()
+        prefill_run = prefill_naive = new_tokens = gen_rows = 0
+        with open(cache_path, "a", encoding="utf-8") as cf:
+            for batch_size in sorted({s["batch_size"] for s in settings}, reverse=True):
+                group = [s for s in settings if s["batch_size"] == batch_size]
+                rows = [i for i in todo if any(s["keys"][i] not in cache for s in group)]
+                if not rows:
+                    continue
+                row_ids = tok([prompts[i] for i in rows])["input_ids"]
+                buckets = [[rows[j] for j in b] for b in length_buckets([len(ids) for ids in row_ids], batch_size)]
+                for n_b, b in enumerate(buckets, 1):
+                    pending = [s for s in group if any(s["keys"][i] not in cache for i in b)]
+                    inputs = tok([prompts[i] for i in b], return_tensors="pt", padding=True)
+                    kv = prefill_kv(engine.model, inputs)
+                    n_prefill = int(inputs["attention_mask"].sum()) - len(b)
+                    prefill_run += n_prefill
+                    prefill_naive += n_prefill * len(pending)
+                    for s in pending:
+                        if s["seed"] is not None:
+                            torch.manual_seed(row_seed(s["seed"], prompts[b[0]]))  # batch of one
+                        stats = {}
+                        gens = generate_from_inputs(tok, engine.model, {**inputs, "past_key_values": fork_kv(kv)},
+                                                    s["gen_kwargs"], stats, args.echo_prompt)
+                        for i, gen, ntok in zip(b, gens, stats["row_tokens"]):
+                            cache[s["keys"][i]] = {"output": gen, "gen_tokens": ntok}
+                            json.dump({"key": s["keys"][i], "output": gen, "gen_tokens": ntok}, cf, ensure_ascii=False)
+                            cf.write("\n")
+                        new_tokens += stats["new_tokens"]
+                        gen_rows += len(b)
+                    cf.flush()
+                    print(f"[sweep] batch {n_b}/{len(buckets)} (size {batch_size}): "
+                          f"{len(b)} prompts × {len(pending)} settings from one prefill")
+
+        saved = prefill_naive - prefill_run
+        print(f"[sweep] prefill tokens computed {prefill_run} vs {prefill_naive} with one run per setting "
+              f"({100 * saved / max(1, prefill_naive):.1f}% saved)")
+        log_throughput(f"{name}[sweep x{len(settings)}]", gen_rows, new_tokens, time.perf_counter() - t0,
+                       1, torch.get_num_threads(), args.batch_size, args.precision, peak_rss_mb())
+
+    for s in settings:
+        with open(s["out_path"], "w", encoding="utf-8") as wf:
+            for p, k in zip(prompts, s["keys"]):
+                row = cache[k]
+                json.dump({"prompt": p, "output": row["output"], "gen_tokens": row.get("gen_tokens")},
+                          wf, ensure_ascii=False)
+                wf.write("\n")
+        print(f"✅ wrote {total} generations to {s['out_path']}")
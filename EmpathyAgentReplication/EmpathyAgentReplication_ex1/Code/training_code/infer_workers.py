@@ -0,0 +1,85 @@
+# Data-parallel CPU inference for infer_lora_min.py --workers N: spawned processes, each pinned to its own
+# core slice with base + adapter loaded once, stream generated rows back to the parent as they finish.
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+import os, sys, queue
+import multiprocessing as mp
+
+THIS_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(THIS_DIR))
+from infer_lora_min import load_model, build_prefix_cache, load_assist, generate_batch
+
+
+def core_slices(workers: int) -> List[List[int]]:
+    """Split the cores this process may use into `workers` contiguous, disjoint slices."""
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    per = max(1, len(cores) // workers)
+    return [cores[k * per:(k + 1) * per] or cores for k in range(workers)]
+
+
+def _worker(rank: int, cores: List[int], base_model: str, adapter_dir: Path, load_kwargs: dict,
+            batches: List[Tuple[List[int], List[str]]], gen_kwargs: dict, opts: dict, q):
+    """
+    Pin to `cores`, load base + adapter once, stream (idxs, outputs, row_tokens, row_metrics) back on `q`.
+    `opts`: prefix_ids, echo_prompt, draft_model, num_draft_tokens (see run_prompts_file()).
+    """
+    import torch
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    tok, model = load_model(base_model, adapter_dir, **load_kwargs)
+    prefix = build_prefix_cache(model, opts["prefix_ids"]) if opts.get("prefix_ids") else None
+    assist = None
+    if opts.get("draft_model"):
+        assist = load_assist(opts["draft_model"], tok, opts["num_draft_tokens"], load_kwargs.get("precision", "fp32"))
+    stats = {}
+    for idxs, prompts in batches:
+        gens = generate_batch(tok, model, prompts, gen_kwargs, stats, prefix, opts.get("echo_prompt", False), assist)
+        q.put((idxs, gens, stats["row_tokens"], stats["row_metrics"]))
+    stats.pop("row_tokens", None)
+    stats.pop("row_metrics", None)
+    q.put((None, rank, stats, None))  # this worker is done; totals for the run summary
+
+
+def iter_worker_results(workers: int, base_model: str, adapter_dir: Path, load_kwargs: dict,
+                        prompts: List[str], buckets: List[List[int]], gen_kwargs: dict, opts: dict,
+                        run_stats: Optional[dict] = None
+                        ) -> Iterator[Tuple[List[int], List[str], List[int], List[dict]]]:
+    """
+    Data-parallel generation: buckets are dealt round-robin to `workers` spawned processes
+    (each with its own core slice and torch thread pool); results are yielded as they arrive.
+    Each worker's final counters are summed into `run_stats`.
+    """
+    ctx = mp.get_context("spawn")
+    q = ctx.Queue()
+    procs = []
+    for rank, cores in enumerate(core_slices(workers)):
+        batches = [(idxs, [prompts[i] for i in idxs]) for idxs in buckets[rank::workers]]
+        p = ctx.Process(target=_worker, daemon=True,
+                        args=(rank, cores, base_model, adapter_dir, load_kwargs, batches, gen_kwargs, opts, q))
+        p.start()
+        procs.append(p)
+        print(f"[workers] rank {rank}: {len(batches)} batches on cores {cores[0]}–{cores[-1]} "
+              f"({len(cores)} threads)")
+
+    running = len(procs)
+    while running:
+        try:
+            idxs, gens, row_tokens, row_metrics = q.get(timeout=5)
+        except queue.Empty:
+            dead = [p for p in procs if p.exitcode not in (None, 0)]
+            if dead:
+                raise RuntimeError(f"Inference worker exited with code {dead[0].exitcode}")
+            continue
+        if idxs is None:
+            running -= 1
+            if run_stats is not None:
+                for k, v in row_tokens.items():
+                    run_stats[k] = run_stats.get(k, 0) + v
+            continue
+        yield idxs, gens, row_tokens, row_metrics
+    for p in procs:
+        p.join()
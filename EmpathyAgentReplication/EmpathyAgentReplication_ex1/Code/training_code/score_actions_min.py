@@ -18,33 +18,52 @@ def jaccard(a: str, b: str) -> float:
     if not A or not B:  return 0.0
     return len(A & B) / len(A | B)
 
+def lcs_length(x: List[str], y: List[str]) -> int:
+    """
+    LCS length, bit-parallel (Hyyrö): tokens are interned to ids, the longer side becomes one bitmask per id,
+    and each token of the shorter side costs a few big-int operations instead of a row of the O(m·n) DP.
+    Bit i of `v` is 0 where the LCS grows at x[i]; the answer is the number of 0 bits.
+    """
+    if len(x) < len(y):
+        x, y = y, x
+    ids, masks = {}, []
+    for i, t in enumerate(x):
+        k = ids.setdefault(t, len(ids))
+        if k == len(masks):
+            masks.append(0)
+        masks[k] |= 1 << i
+    full = (1 << len(x)) - 1
+    v = full
+    for k in (ids.get(t) for t in y):
+        if k is not None:
+            u = v & masks[k]
+            v = ((v + u) | (v - u)) & full
+    return len(x) - bin(v).count("1")
+
 def lcs_norm(a: str, b: str) -> float:
     x, y = _tok(a), _tok(b)
     if not x and not y: return 1.0
     if not x or not y:  return 0.0
-    m, n = len(x), len(y)
-    dp = [0]*(n+1)
-    for _ in range(1, m+1):
-        prev = 0
-        for j in range(1, n+1):
-            tmp, prev = dp[j], dp[j-1]+1 if x[_-1]==y[j-1] else max(dp[j], dp[j-1])
-            dp[j] = prev
-            prev = tmp
-    l = dp[n]
-    return l / max(m, n)
-
-def tfidf_cosine_batch(preds: List[str], refs: List[str]) -> List[float]:
+    return lcs_length(x, y) / max(len(x), len(y))
+
+def fit_tfidf(texts: List[str]):
+    """TF-IDF vocabulary + idf weights; fit once (e.g. on the references) and pass as `vec` to reuse it."""
     from sklearn.feature_extraction.text import TfidfVectorizer
-    texts = refs + preds
-    vec = TfidfVectorizer(min_df=1).fit(texts)
-    V = vec.transform(texts)
-    R, Pm = V[:len(refs)], V[len(refs):]
-    sims = []
-    for i in range(len(refs)):
-        r, p = R[i], Pm[i]
-        denom = (r.power(2).sum()**0.5) * (p.power(2).sum()**0.5)
-        sims.append(float((r @ p.T)[0,0] / denom) if denom else 0.0)
-    return sims
+    return TfidfVectorizer(min_df=1).fit(texts)
+
+def tfidf_cosine_batch(preds: List[str], refs: List[str], vec=None) -> List[float]:
+    """
+    Cosine of each (pred, ref) pair, all rows at once: the row sums of the element-wise products of the
+    two sparse matrices are the dot products and the squared norms. `vec` defaults to one fitted on refs + preds.
+    """
+    import numpy as np
+    if vec is None:
+        vec = fit_tfidf(refs + preds)
+    R, Pm = vec.transform(refs), vec.transform(preds)
+    row_sum = lambda M: np.asarray(M.sum(axis=1), dtype=np.float64).ravel()
+    dots = row_sum(R.multiply(Pm))
+    denom = np.sqrt(row_sum(R.multiply(R))) * np.sqrt(row_sum(Pm.multiply(Pm)))
+    return np.divide(dots, denom, out=np.zeros_like(dots), where=denom > 0).tolist()
 
 def read_predictions(csv_path: Path) -> List[str]:
     with open(csv_path, newline="", encoding="utf-8") as f:
@@ -100,6 +119,8 @@ def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--adapter_name", default="lora_tinyllama_min")
     ap.add_argument("--references", required=True, help="Path to gold refs (json/jsonl/csv)")
+    ap.add_argument("--tfidf_vocab", choices=["both", "refs"], default="both",
+                    help="Fit TF-IDF on refs + predictions (default) or on the refs only (comparable across adapters).")
     args = ap.parse_args()
 
     adir = P.OUTPUT_DIR / args.adapter_name
@@ -120,7 +141,7 @@ def main():
 
     jac = [jaccard(p, r) for p, r in zip(preds, refs)]
     lcs = [lcs_norm(p, r) for p, r in zip(preds, refs)]
-    tfc = tfidf_cosine_batch(preds, refs)
+    tfc = tfidf_cosine_batch(preds, refs, fit_tfidf(refs) if args.tfidf_vocab == "refs" else None)
 
     out_csv = adir / "scores.csv"
     with open(out_csv, "w", newline="", encoding="utf-8") as wf:
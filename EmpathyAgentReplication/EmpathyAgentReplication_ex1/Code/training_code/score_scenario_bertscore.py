@@ -3,9 +3,6 @@ from pathlib import Path
 import sys, argparse, json, csv
 from statistics import mean
 
-# If you hit ModuleNotFoundError: bert_score → pip install bert-score
-from bert_score import score as bertscore
-
 # Make Code/ importable so we can use cfg_paths.py
 THIS_DIR = Path(__file__).resolve().parent
 CODE_DIR = THIS_DIR.parent
@@ -53,6 +50,9 @@ def main():
     if n == 0:
         raise RuntimeError("No comparable rows to score.")
 
+    # imported here: bert_score pulls in torch + transformers, which --help and input errors do not need
+    # (if you hit ModuleNotFoundError: bert_score → pip install bert-score)
+    from bert_score import score as bertscore
     P_list, R_list, F1_list = bertscore(
         cands=preds, refs=refs,
         model_type=args.model_type,
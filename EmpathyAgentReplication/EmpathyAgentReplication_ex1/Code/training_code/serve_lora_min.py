@@ -0,0 +1,212 @@
+# Persistent local LoRA inference server (Python 3.9 compatible, stdlib HTTP only)
+# Keeps tokenizer + base + adapter resident and micro-batches concurrent requests.
+#
+# Run (from Code/):
+#   python training_code/serve_lora_min.py --adapter_name lora_tinyllama_min --greedy --max_new_tokens 160
+#   curl -s localhost:8765/generate -d '{"instruction": "Comfort a teen after a sibling fight.", "input": "..."}'
+#   curl -s localhost:8765/stats
+# or over a Unix socket:
+#   python training_code/serve_lora_min.py --socket /tmp/lora.sock
+#   curl -s --unix-socket /tmp/lora.sock http://x/generate -d '{"prompt": "..."}'
+from pathlib import Path
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+import os, sys, argparse, json, socketserver, threading, time, queue
+
+# infer_lora_min.py lives next to this file; it also puts Code/ on sys.path for cfg_paths
+THIS_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(THIS_DIR))
+from infer_lora_min import P, PRECISIONS, fmt, gen_kwargs_from_args, generate_batch, load_model, percentile
+
+
+class _Pending:
+    """One queued request: filled in by the batcher thread, awaited by the HTTP handler thread."""
+    __slots__ = ("prompt", "gen_kwargs", "t_submit", "done", "output", "error")
+
+    def __init__(self, prompt: str, gen_kwargs: dict):
+        self.prompt = prompt
+        self.gen_kwargs = gen_kwargs
+        self.t_submit = time.perf_counter()
+        self.done = threading.Event()
+        self.output = None  # type: Optional[str]
+        self.error = None   # type: Optional[str]
+
+
+class Batcher:
+    """
+    Single model thread. Waits for a request, then keeps collecting for up to `window_ms`
+    (or until `max_batch`), and runs one generate_batch() per group of equal decoding params.
+    """
+
+    def __init__(self, tok, model, max_batch: int, window_ms: float):
+        self.tok, self.model = tok, model
+        self.max_batch, self.window = max_batch, window_ms / 1000.0
+        self.q = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies_ms = deque(maxlen=10000)
+        self.batch_sizes = Counter()
+        self.served = 0
+        self.t_start = time.time()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def submit(self, prompt: str, gen_kwargs: dict) -> _Pending:
+        item = _Pending(prompt, gen_kwargs)
+        self.q.put(item)
+        return item
+
+    def _loop(self):
+        while True:
+            batch = [self.q.get()]
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch:
+                left = deadline - time.perf_counter()
+                if left <= 0:
+                    break
+                try:
+                    batch.append(self.q.get(timeout=left))
+                except queue.Empty:
+                    break
+
+            groups = {}
+            for item in batch:
+                groups.setdefault(json.dumps(item.gen_kwargs, sort_keys=True), []).append(item)
+            for items in groups.values():
+                try:
+                    outs = generate_batch(self.tok, self.model, [it.prompt for it in items], items[0].gen_kwargs)
+                except Exception as e:  # report to every waiter instead of killing the thread
+                    outs, err = [None] * len(items), f"{type(e).__name__}: {e}"
+                else:
+                    err = None
+                now = time.perf_counter()
+                with self.lock:
+                    self.batch_sizes[len(items)] += 1
+                    for it, out in zip(items, outs):
+                        it.output, it.error = out, err
+                        self.latencies_ms.append((now - it.t_submit) * 1000)
+                        self.served += 1
+                for it in items:
+                    it.done.set()
+
+    def stats(self) -> dict:
+        with self.lock:
+            lat = list(self.latencies_ms)
+            hist = dict(sorted(self.batch_sizes.items()))
+            served = self.served
+        return {
+            "served": served,
+            "uptime_s": round(time.time() - self.t_start, 1),
+            "queue_depth": self.q.qsize(),
+            "latency_ms": {f"p{q}": round(percentile(lat, q), 1) for q in (50, 90, 95, 99)},
+            "batch_size_hist": {str(k): v for k, v in hist.items()},
+        }
+
+
+def make_handler(batcher: Batcher, tok, defaults: argparse.Namespace):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code: int, payload: dict):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def address_string(self):
+            # Unix sockets have no (host, port) client address
+            return self.client_address[0] if self.client_address else "unix"
+
+        def do_GET(self):
+            if self.path == "/stats":
+                return self._send(200, batcher.stats())
+            if self.path == "/health":
+                return self._send(200, {"ok": True, "adapter": defaults.adapter_name})
+            self._send(404, {"error": f"unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/generate":
+                return self._send(404, {"error": f"unknown path {self.path}"})
+            try:
+                req = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            except ValueError as e:
+                return self._send(400, {"error": f"bad JSON: {e}"})
+
+            # Same prompt handling as infer_lora_min.py (--prompt and --prompts_file rows)
+            if req.get("prompt"):
+                prompt = req["prompt"] if "### Instruction" in req["prompt"] else fmt(req["prompt"])
+            else:
+                prompt = fmt(req.get("instruction") or "Respond empathetically.", req.get("input"))
+
+            # Per-request decoding overrides fall back to the server's CLI flags
+            opts = argparse.Namespace(**vars(defaults))
+            for k in ("max_new_tokens", "temperature", "greedy"):
+                if k in req:
+                    setattr(opts, k, req[k])
+            item = batcher.submit(prompt, gen_kwargs_from_args(tok, opts))
+            item.done.wait()
+            if item.error:
+                return self._send(500, {"error": item.error})
+            self._send(200, {"prompt": prompt, "output": item.output,
+                             "latency_ms": round((time.perf_counter() - item.t_submit) * 1000, 1)})
+
+        def log_message(self, fmt_, *args):
+            if defaults.verbose:
+                super().log_message(fmt_, *args)
+
+    return Handler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--base_model", default="TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+    ap.add_argument("--adapter_name", default="lora_tinyllama_min")
+    ap.add_argument("--max_new_tokens", type=int, default=150)
+    ap.add_argument("--temperature", type=float, default=0.7)
+    ap.add_argument("--greedy", action="store_true",
+                    help="Deterministic decoding (do_sample=False). Use this instead of temperature=0.")
+    ap.add_argument("--merged", action="store_true",
+                    help="Serve the adapter folded into the base weights (see infer_lora_min.py --merged).")
+    ap.add_argument("--precision", choices=PRECISIONS, default="fp32")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--socket", default=None, help="Listen on this Unix socket path instead of host:port.")
+    ap.add_argument("--max_batch", type=int, default=8)
+    ap.add_argument("--window_ms", type=float, default=20.0,
+                    help="How long the batcher waits for more requests after the first one arrives.")
+    ap.add_argument("--verbose", action="store_true", help="Log every HTTP request.")
+    args = ap.parse_args()
+
+    adapter_dir = P.OUTPUT_DIR / args.adapter_name
+    if not adapter_dir.exists():
+        raise FileNotFoundError(f"Adapter not found: {adapter_dir}")
+    t0 = time.perf_counter()
+    tok, model = load_model(args.base_model, adapter_dir, merged=args.merged, precision=args.precision)
+    print(f"[serve] model ready in {time.perf_counter() - t0:.1f}s")
+
+    batcher = Batcher(tok, model, args.max_batch, args.window_ms)
+    handler = make_handler(batcher, tok, args)
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, handler)
+        where = f"unix:{args.socket}"
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        where = f"http://{args.host}:{args.port}"
+    print(f"✅ serving {args.adapter_name} on {where} (POST /generate, GET /stats, GET /health)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    main()
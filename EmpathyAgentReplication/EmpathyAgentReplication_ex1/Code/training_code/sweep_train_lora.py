@@ -0,0 +1,178 @@
+# LoRA hyperparameter sweep on CPU: one tokenization, a pool of workers that each load the base model once
+# and train every trial they pick up with a fresh LoRA (r, lora_alpha, learning_rate, lora_dropout, target_modules).
+# Run (from Code/):
+#   python training_code/sweep_train_lora.py --sweep "r=4,8,16;lora_alpha=16,32;learning_rate=1e-4,2e-4" \
+#          --max_steps 30 --batch_size 4 --pack
+#   python training_code/sweep_train_lora.py --sweep "r=8;target_modules=q_proj+v_proj,all" --workers 2
+#   python training_code/sweep_train_lora.py --sweep ./lora_grid.json     # {key: [values]} or [{...}, ...]
+from pathlib import Path
+import os, sys, argparse, csv, time, queue
+import multiprocessing as mp
+
+THIS_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(THIS_DIR))
+from infer_lora_min import P, peak_rss_mb
+from infer_sweep import parse_sweep, setting_tag
+from infer_workers import core_slices
+from train_lora_min import LORA_TARGETS, lora_config, build_train_dataset, PackedCollator
+
+TRAIN_SWEEP_KEYS = {"r": "r", "lora_alpha": "a", "learning_rate": "lr", "lora_dropout": "d", "target_modules": "tm"}
+
+
+def target_modules(value) -> list:
+    """'all' → LORA_TARGETS; 'q_proj+v_proj' or a JSON list → those module names."""
+    if value in (None, "all"):
+        return LORA_TARGETS
+    return value if isinstance(value, list) else value.split("+")
+
+
+def _trial_worker(rank: int, cores: list, args: argparse.Namespace, tasks, results):
+    """Pin to `cores`, load tokenizer + base model + cached dataset once, then train trials until a None task."""
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer, DataCollatorForLanguageModeling, Trainer, \
+        TrainingArguments, set_seed
+    from peft import get_peft_model
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+    tok = AutoTokenizer.from_pretrained(args.base_model, use_fast=True)
+    if tok.pad_token is None:
+        tok.pad_token = tok.eos_token
+    tok.padding_side = "right"
+    base = AutoModelForCausalLM.from_pretrained(args.base_model, low_cpu_mem_usage=True)
+    ds, _ = build_train_dataset(Path(args.train_file), tok, args.max_length, pack=args.pack)  # cache hit
+    collator = PackedCollator() if args.pack else DataCollatorForLanguageModeling(tok, mlm=False)
+    avg_len = sum(ds["length"]) / len(ds)
+
+    while True:
+        trial = tasks.get()
+        if trial is None:
+            break
+        setting, tag = trial["setting"], trial["tag"]
+        out_dir = P.OUTPUT_DIR / args.sweep_name / tag
+        set_seed(args.seed)  # same LoRA init and data order for every trial
+        rss_before = peak_rss_mb()  # the worker's high-water mark so far (base model + earlier trials)
+        model = get_peft_model(base, lora_config(r=setting.get("r", 8), lora_alpha=setting.get("lora_alpha", 16),
+                                                 lora_dropout=setting.get("lora_dropout", 0.05),
+                                                 target_modules=target_modules(setting.get("target_modules"))))
+        targs = TrainingArguments(
+            output_dir=str(out_dir),
+            max_steps=args.max_steps,
+            per_device_train_batch_size=args.batch_size,
+            gradient_accumulation_steps=args.grad_accum,
+            group_by_length=not args.pack,
+            length_column_name="length",
+            remove_unused_columns=not args.pack,
+            learning_rate=setting.get("learning_rate", 2e-4),
+            warmup_ratio=0.03,
+            logging_steps=5,
+            save_strategy="no",
+            report_to="none",
+            disable_tqdm=True,
+            seed=args.seed,
+        )
+        trainer = Trainer(model=model, args=targs, train_dataset=ds, data_collator=collator, tokenizer=tok)
+        result = trainer.train()
+        losses = [h["loss"] for h in trainer.state.log_history if "loss" in h]
+        runtime = result.metrics["train_runtime"]
+        real = trainer.state.global_step * args.batch_size * args.grad_accum * avg_len
+        if args.save_adapters:
+            model.save_pretrained(str(out_dir))
+            tok.save_pretrained(str(out_dir))
+        base = model.unload()  # strip the LoRA layers: the next trial starts from the plain base model again
+        results.put({"tag": tag, **setting, "worker": rank, "seconds": round(runtime, 2),
+                     "real_tokens_per_s": round(real / runtime, 2), "final_loss": round(losses[-1], 4) if losses else None,
+                     "mean_loss": round(result.training_loss, 4),
+                     "peak_rss_growth_mb": round(peak_rss_mb() - rss_before), "worker_peak_rss_mb": round(peak_rss_mb())})
+    results.put(None)  # this worker is done
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sweep", required=True,
+                    help='Grid like "r=4,8;lora_alpha=16,32;learning_rate=1e-4,2e-4;target_modules=q_proj+v_proj,all" '
+                         "or a .json file ({key: [values]} or a list of settings).")
+    ap.add_argument("--sweep_name", default="lora_sweep", help="Trials go to OUTPUT_DIR/<sweep_name>/<trial tag>/.")
+    ap.add_argument("--base_model", default="TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+    ap.add_argument("--train_file", default=str((P.CODE_DIR / "sft_empathyagent_mini.jsonl").resolve()))
+    ap.add_argument("--max_steps", type=int, default=30)
+    ap.add_argument("--max_length", type=int, default=768)
+    ap.add_argument("--batch_size", type=int, default=1)
+    ap.add_argument("--grad_accum", type=int, default=1)
+    ap.add_argument("--pack", action="store_true")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--workers", type=int, default=0,
+                    help="Trials trained at once, each on its own core slice with its own base model copy "
+                         "(0 = one per 8 cores, at most one per trial).")
+    ap.add_argument("--save_adapters", action="store_true", help="Keep each trial's adapter in its folder.")
+    args = ap.parse_args()
+
+    settings = parse_sweep(args.sweep, TRAIN_SWEEP_KEYS)
+    trials = [{"setting": s, "tag": setting_tag(s, TRAIN_SWEEP_KEYS)} for s in settings]
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    workers = min(len(trials), args.workers or max(1, cores // 8))
+
+    # tokenize once here; every worker then memory-maps the same Arrow cache
+    from transformers import AutoTokenizer
+    tok = AutoTokenizer.from_pretrained(args.base_model, use_fast=True)
+    if tok.pad_token is None:
+        tok.pad_token = tok.eos_token
+    build_train_dataset(Path(args.train_file), tok, args.max_length, pack=args.pack, num_proc=min(8, cores))
+
+    ctx = mp.get_context("spawn")
+    tasks, results = ctx.Queue(), ctx.Queue()
+    for t in trials + [None] * workers:  # free workers pull the next trial; one None stops each worker
+        tasks.put(t)
+    procs = []
+    for rank, slice_ in enumerate(core_slices(workers)):
+        p = ctx.Process(target=_trial_worker, args=(rank, slice_, args, tasks, results), daemon=True)
+        p.start()
+        procs.append(p)
+        print(f"[sweep] worker {rank}: cores {slice_[0]}–{slice_[-1]} ({len(slice_)} threads)")
+    print(f"[sweep] {len(trials)} trials × {args.max_steps} steps on {workers} worker(s)")
+
+    t0, rows, running = time.perf_counter(), [], len(procs)
+    while running:
+        try:
+            row = results.get(timeout=5)
+        except queue.Empty:
+            dead = [p for p in procs if p.exitcode not in (None, 0)]
+            if dead:
+                raise RuntimeError(f"Sweep worker exited with code {dead[0].exitcode}")
+            continue
+        if row is None:
+            running -= 1
+            continue
+        rows.append(row)
+        print(f"[sweep] {len(rows)}/{len(trials)} {row['tag']}: final loss {row['final_loss']} | "
+              f"{row['real_tokens_per_s']:.1f} tok/s | {row['seconds']:.1f}s (worker {row['worker']})")
+    for p in procs:
+        p.join()
+    wall = time.perf_counter() - t0
+
+    rows.sort(key=lambda r: float("inf") if r["final_loss"] is None else r["final_loss"])
+    out_dir = P.OUTPUT_DIR / args.sweep_name
+    out_dir.mkdir(parents=True, exist_ok=True)
+    out_csv = out_dir / "sweep_results.csv"
+    # peak RSS is a per-process high-water mark: worker_peak_rss_mb covers the worker's whole life so far,
+    # peak_rss_growth_mb is how far this trial pushed it (0 = it fit in what earlier trials already used)
+    cols = ["tag", *TRAIN_SWEEP_KEYS, "worker", "seconds", "real_tokens_per_s", "final_loss", "mean_loss",
+            "peak_rss_growth_mb", "worker_peak_rss_mb"]
+    with open(out_csv, "w", newline="", encoding="utf-8") as wf:
+        w = csv.DictWriter(wf, fieldnames=cols, extrasaction="ignore")
+        w.writeheader()
+        for r in rows:
+            w.writerow({**r, "target_modules": "+".join(target_modules(r["target_modules"]))
+                        if "target_modules" in r else ""})
+    print("==================================================")
+    print(f"{'trial':<32} {'tok/s':>8} {'seconds':>8} {'final':>7} {'mean':>7}")
+    for r in rows:
+        print(f"{r['tag']:<32} {r['real_tokens_per_s']:>8.1f} {r['seconds']:>8.1f} "
+              f"{r['final_loss'] if r['final_loss'] is not None else '-':>7} {r['mean_loss']:>7}")
+    print(f"[sweep] {len(rows)} trials in {wall:.1f}s wall ({sum(r['seconds'] for r in rows):.1f}s of training)")
+    print(f"✅ wrote {out_csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,12 +9,17 @@ Run:
          --train_file ./sft_empathyagent_mini.jsonl
 """
 from pathlib import Path
-import argparse, json
+from typing import Iterable, Iterator, List, Optional, Tuple
+import os, argparse, json, random, hashlib, inspect, shutil, time, csv, subprocess, copy, re
+from concurrent.futures import ThreadPoolExecutor
 
-from datasets import load_dataset
-from transformers import (AutoModelForCausalLM, AutoTokenizer,
-                          DataCollatorForLanguageModeling, Trainer, TrainingArguments)
-from peft import LoraConfig, get_peft_model, TaskType
+import torch
+from datasets import Dataset, load_dataset, load_from_disk
+from transformers import (AutoModelForCausalLM, AutoTokenizer, DataCollatorForLanguageModeling,
+                          Trainer, TrainerCallback, TrainingArguments)
+from transformers.trainer_utils import get_last_checkpoint
+from safetensors.torch import save_file, load_file
+from peft import LoraConfig, get_peft_model, get_peft_model_state_dict, set_peft_model_state_dict, TaskType
 
 # Make the parent "Code" folder importable so we can find cfg_paths.py
 from pathlib import Path
@@ -24,6 +29,8 @@ CODE_DIR = THIS_DIR.parent          # .../EmpathyAgentReplication_ex1/Code
 sys.path.insert(0, str(CODE_DIR))
 
 import cfg_paths as P
+from infer_lora_min import peak_rss_mb, start_trace, finish_trace, generate_batch, gen_kwargs_from_args
+from score_actions_min import jaccard, lcs_norm, tfidf_cosine_batch
 
 def guess_text(example):
     # Try common SFT schemas
@@ -48,6 +55,613 @@ def guess_text(example):
     # last resort: dump the row
     return json.dumps(example)
 
+# Bump when tokenize/pack below change what a row turns into (guess_text() edits are picked up by hash)
+TEMPLATE_VERSION = 1
+
+def _sha256_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def tokenizer_fingerprint(tok) -> str:
+    """Hash of the full tokenizer definition (vocab, merges, normalizer) plus the special ids we rely on."""
+    h = hashlib.sha256(f"{tok.name_or_path}\x00{tok.eos_token_id}\x00{tok.pad_token_id}".encode("utf-8"))
+    if hasattr(tok, "backend_tokenizer"):
+        h.update(tok.backend_tokenizer.to_str().encode("utf-8"))
+    else:
+        h.update(json.dumps(tok.get_vocab(), sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+def dataset_cache_dir(train_path: Path, tok, max_length: int, pad_to_max_length: bool, pack: bool) -> Path:
+    """OUTPUT_DIR/tokenized_cache/<hash of train file, template, tokenizer, max_length, padding/packing mode>/"""
+    key = json.dumps({
+        "train_file": _sha256_file(train_path),
+        "template": [TEMPLATE_VERSION, hashlib.sha256(inspect.getsource(guess_text).encode("utf-8")).hexdigest()],
+        "tokenizer": tokenizer_fingerprint(tok),
+        "max_length": max_length,
+        "pad_to_max_length": pad_to_max_length,
+        "pack": pack,
+    }, sort_keys=True)
+    return P.OUTPUT_DIR / "tokenized_cache" / hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+def build_train_dataset(train_path: Path, tok, max_length: int, pad_to_max_length: bool = False,
+                        pack: bool = False, num_proc: int = 1, refresh: bool = False) -> Tuple[Dataset, dict]:
+    """
+    JSONL → tokenized (optionally packed) Dataset, saved as Arrow under dataset_cache_dir() and
+    memory-mapped back on later runs with the same file, template, tokenizer and length settings.
+    Returns (dataset, info) where info holds the pre-packing example count and token total.
+    """
+    cache_dir = dataset_cache_dir(train_path, tok, max_length, pad_to_max_length, pack)
+    info_path = cache_dir / "prep_info.json"
+    t0 = time.perf_counter()
+    if info_path.exists() and not refresh:
+        ds = load_from_disk(str(cache_dir))
+        with open(info_path, "r", encoding="utf-8") as f:
+            info = json.load(f)
+        print(f"[data] tokenized cache hit: {len(ds)} rows ← {cache_dir} ({time.perf_counter() - t0:.1f}s)")
+        return ds, info
+
+    ds = load_dataset("json", data_files=str(train_path), split="train")
+    # a few thousand rows per worker, or the process start-up costs more than it saves
+    procs = max(1, min(num_proc, len(ds) // 2000))
+
+    def to_text(batch):
+        cols = list(batch)
+        return {"text": [guess_text({c: batch[c][i] for c in cols}) for i in range(len(batch[cols[0]]))]}
+
+    def tokenize(batch):
+        # no padding here: the collator pads each batch to its own longest row
+        enc = tok(batch["text"], truncation=True, max_length=max_length,
+                  padding="max_length" if pad_to_max_length else False)
+        enc["length"] = [sum(m) for m in enc["attention_mask"]]  # real tokens; read by the group_by_length sampler
+        return enc
+
+    ds = ds.map(to_text, batched=True, num_proc=procs if procs > 1 else None, remove_columns=ds.column_names)
+    ds = ds.map(tokenize, batched=True, num_proc=procs if procs > 1 else None, remove_columns=["text"])
+    info = {"train_file": str(train_path), "examples": len(ds), "example_tokens": sum(ds["length"])}
+    if pack:
+        ds = Dataset.from_dict(pack_examples(ds["input_ids"], max_length, tok.eos_token_id, tok.pad_token_id))
+
+    # write next to the final location, then swap in, so a killed run never leaves a half cache behind
+    tmp_dir = cache_dir.with_name(cache_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    ds.save_to_disk(str(tmp_dir))
+    with open(tmp_dir / "prep_info.json", "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    tmp_dir.rename(cache_dir)
+    ds = load_from_disk(str(cache_dir))
+    print(f"[data] tokenized {info['examples']} examples in {time.perf_counter() - t0:.1f}s "
+          f"(num_proc={procs}) → {cache_dir}")
+    return ds, info
+
+def padding_efficiency(lengths: List[int], batch_size: int, max_length: Optional[int] = None,
+                       seed: int = 42) -> float:
+    """
+    Real tokens / tokens the model computes. With max_length every row is padded to it (the old
+    padding="max_length" path); otherwise rows are batched like Trainer's group_by_length sampler
+    (shuffled megabatches of 50 batches, each sorted longest first) and padded to their batch's longest row.
+    """
+    if max_length:
+        return sum(lengths) / (len(lengths) * max_length)
+    order = list(range(len(lengths)))
+    random.Random(seed).shuffle(order)
+    computed, mega = 0, 50 * batch_size
+    for m in range(0, len(order), mega):
+        chunk = sorted(order[m:m + mega], key=lambda i: -lengths[i])
+        for b in range(0, len(chunk), batch_size):
+            batch = chunk[b:b + batch_size]
+            computed += len(batch) * max(lengths[i] for i in batch)
+    return sum(lengths) / computed
+
+def iter_packed_blocks(id_lists: Iterable[List[int]], block_len: int, eos_id: int, pad_id: int) -> Iterator[dict]:
+    """
+    Next-fit packing: each tokenized example (+EOS) is appended to the current block until the next
+    one does not fit; the rest of the block is padding. position_ids restart at 0 for every example
+    (and for the pad tail), which PackedCollator turns into a block-diagonal causal mask, and the first
+    token of each example gets label -100 so nothing is predicted across a boundary.
+    """
+    ids_, pos_, lab_ = [], [], []
+
+    def block() -> dict:
+        gap = block_len - len(ids_)
+        return {"input_ids": ids_ + [pad_id] * gap, "position_ids": pos_ + list(range(gap)),
+                "labels": lab_ + [-100] * gap, "length": len(ids_)}
+
+    for ids in id_lists:
+        ids = (ids if ids and ids[-1] == eos_id else ids + [eos_id])[:block_len]
+        if ids_ and len(ids_) + len(ids) > block_len:
+            yield block()
+            ids_, pos_, lab_ = [], [], []
+        ids_ += ids
+        pos_ += list(range(len(ids)))
+        lab_ += [-100] + ids[1:]
+    if ids_:
+        yield block()
+
+def pack_examples(id_lists: List[List[int]], block_len: int, eos_id: int, pad_id: int) -> dict:
+    """iter_packed_blocks() over a whole dataset, as columns for Dataset.from_dict."""
+    cols = {"input_ids": [], "position_ids": [], "labels": [], "length": []}
+    for blk in iter_packed_blocks(id_lists, block_len, eos_id, pad_id):
+        for k, v in blk.items():
+            cols[k].append(v)
+    return cols
+
+def _shuffled(items: Iterable, buffer_size: int, seed: int) -> Iterator:
+    """Streaming shuffle: keep `buffer_size` items and emit a random one as each new item arrives."""
+    rng, buf = random.Random(seed), []
+    for x in items:
+        if len(buf) < buffer_size:
+            buf.append(x)
+            continue
+        k = rng.randrange(buffer_size)
+        yield buf[k]
+        buf[k] = x
+    rng.shuffle(buf)
+    yield from buf
+
+class StreamingSFT(torch.utils.data.IterableDataset):
+    """
+    --streaming: the JSONL is read line by line and each row goes through guess_text → tokenize
+    (→ shuffle buffer → packing) only when the Trainer asks for it, so memory stays flat whatever the
+    file size. There is no length, so training is bounded by --max_steps; the file restarts when it
+    runs out. `real_tokens` counts the non-pad tokens handed out (for the throughput line).
+    """
+
+    def __init__(self, train_path: Path, tok, max_length: int, pack: bool = False,
+                 shuffle_buffer: int = 0, seed: int = 42):
+        self.train_path, self.tok, self.max_length = train_path, tok, max_length
+        self.pack, self.shuffle_buffer, self.seed = pack, shuffle_buffer, seed
+        self.passes = self.real_tokens = 0
+
+    def _examples(self) -> Iterator[List[int]]:
+        with open(self.train_path, "r", encoding="utf-8", errors="ignore") as f:
+            for line in f:
+                if line.strip():
+                    yield self.tok(guess_text(json.loads(line)), truncation=True, max_length=self.max_length)["input_ids"]
+
+    def __iter__(self):
+        examples = self._examples()
+        if self.shuffle_buffer > 1:
+            examples = _shuffled(examples, self.shuffle_buffer, self.seed + self.passes)
+        self.passes += 1
+        if self.pack:
+            rows = iter_packed_blocks(examples, self.max_length, self.tok.eos_token_id, self.tok.pad_token_id)
+        else:
+            rows = ({"input_ids": ids, "attention_mask": [1] * len(ids)} for ids in examples)
+        for row in rows:
+            self.real_tokens += row.get("length", len(row["input_ids"]))
+            yield row
+
+class PackedCollator:
+    """Stacks packed blocks and builds the 4D mask: token i sees token j iff j <= i in the same example."""
+
+    def __init__(self, dtype=torch.float32):
+        self.dtype = dtype
+
+    def __call__(self, features):
+        ids = torch.tensor([f["input_ids"] for f in features])
+        pos = torch.tensor([f["position_ids"] for f in features])
+        seg = (pos == 0).cumsum(-1)  # example number of every token
+        n = ids.shape[1]
+        allowed = (seg[:, :, None] == seg[:, None, :]) & torch.ones(n, n, dtype=torch.bool).tril()
+        # HF takes a 4D mask already "inverted": 0 where attending, dtype min where blocked
+        mask = torch.zeros(allowed.shape, dtype=self.dtype).masked_fill_(~allowed, torch.finfo(self.dtype).min)
+        return {"input_ids": ids, "position_ids": pos, "attention_mask": mask[:, None],
+                "labels": torch.tensor([f["labels"] for f in features])}
+
+LORA_TARGETS = ["q_proj","k_proj","v_proj","o_proj","gate_proj","up_proj","down_proj"]  # works for most Llama-like models
+
+def lora_config(r: int = 8, lora_alpha: int = 16, lora_dropout: float = 0.05,
+                target_modules: Optional[List[str]] = None) -> LoraConfig:
+    # LoRA config — tiny & fast by default
+    return LoraConfig(
+        task_type=TaskType.CAUSAL_LM,
+        r=r,
+        lora_alpha=lora_alpha,
+        lora_dropout=lora_dropout,
+        target_modules=target_modules or LORA_TARGETS,
+        bias="none"
+    )
+
+def cpu_bf16_supported() -> bool:
+    """True if oneDNN has native bf16 kernels on this CPU (AVX512-BF16 / AMX); elsewhere bf16 is emulated and slow."""
+    check = getattr(torch.ops.mkldnn, "_is_mkldnn_bf16_supported", None)
+    try:
+        return bool(check()) if check is not None else False
+    except RuntimeError:
+        return False
+
+class MemoryCallback(TrainerCallback):
+    """Peak RSS after each optimizer step, printed every logging_steps and summarized at the end."""
+
+    def __init__(self):
+        self.per_step = []
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.per_step.append(peak_rss_mb())
+        if state.is_world_process_zero and (state.global_step == 1 or state.global_step % args.logging_steps == 0):
+            print(f"[memory] step {state.global_step}: peak RSS {self.per_step[-1]:.0f} MB")
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if state.is_world_process_zero and self.per_step:
+            print(f"[memory] peak RSS {max(self.per_step):.0f} MB "
+                  f"(after step 1: {self.per_step[0]:.0f} MB, last step: {self.per_step[-1]:.0f} MB)")
+
+class ThroughputCallback(TrainerCallback):
+    """
+    Per optimizer step → <output_name>/train_metrics.jsonl: wall time, real (non-pad) tokens/s, data vs
+    compute seconds and peak RSS. `collate` wraps the data collator: the DataLoader fetches and collates
+    in this process between micro-steps, so "data" is the time from the end of the last micro-step to
+    the end of the next collate, and the rest of the step is "compute". `profile_steps` = (first, last)
+    runs torch.profiler over those steps and exports a trace next to the metrics.
+    """
+
+    def __init__(self, collator, metrics_path: Path, profile_steps: Optional[Tuple[int, int]] = None):
+        self.collator, self.metrics_path, self.profile_steps = collator, metrics_path, profile_steps
+        self.pending = []  # real tokens of collated batches not yet trained on (the loader prefetches one)
+        self.rows, self.prof = [], None
+
+    def collate(self, features):
+        batch = self.collator(features)
+        self.step_data += time.perf_counter() - self.mark
+        self.pending.append(sum(f["length"] if "length" in f else sum(f["attention_mask"]) for f in features))
+        return batch
+
+    def _micro_step_done(self):
+        self.step_tokens += self.pending.pop(0) if self.pending else 0
+        self.mark = time.perf_counter()
+
+    def restart_clock(self):
+        """Start the next step's clock now (time spent since the last step, e.g. in-training eval, is not a step's)."""
+        self.mark = self.step_start = time.perf_counter()
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.restart_clock()
+        self.step_data, self.step_tokens = 0.0, 0
+        self.metrics_file = open(self.metrics_path, "w", encoding="utf-8") if state.is_world_process_zero else None
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        if self.profile_steps and state.global_step + 1 == self.profile_steps[0] and state.is_world_process_zero:
+            self.prof = start_trace()
+
+    def on_substep_end(self, args, state, control, **kwargs):
+        self._micro_step_done()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self._micro_step_done()
+        wall = self.mark - self.step_start
+        row = {"step": state.global_step, "wall_s": round(wall, 4), "data_s": round(self.step_data, 4),
+               "compute_s": round(wall - self.step_data, 4), "real_tokens": self.step_tokens,
+               "tokens_per_s": round(self.step_tokens / wall, 2), "peak_rss_mb": round(peak_rss_mb(), 1)}
+        self.rows.append(row)
+        if self.metrics_file:
+            self.metrics_file.write(json.dumps(row) + "\n")
+            self.metrics_file.flush()
+        if self.prof and state.global_step == self.profile_steps[1]:
+            first, last = self.profile_steps
+            finish_trace(self.prof, self.metrics_path.with_name("train_trace.json"), f"steps {first}–{last}")
+            self.prof = None
+        self.step_start, self.step_data, self.step_tokens = self.mark, 0.0, 0
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.prof:  # training ended inside the profiled window
+            finish_trace(self.prof, self.metrics_path.with_name("train_trace.json"),
+                         f"steps {self.profile_steps[0]}–{state.global_step}")
+            self.prof = None
+        if self.metrics_file:
+            self.metrics_file.close()
+            print(f"✅ wrote {self.metrics_path} ({len(self.rows)} steps)")
+
+    def summary(self, skip_first: int = 1) -> dict:
+        """Totals over the logged steps, leaving out the first `skip_first` (warm-up: allocator, thread pools)."""
+        rows = self.rows[skip_first:] or self.rows
+        wall = sum(r["wall_s"] for r in rows)
+        data = sum(r["data_s"] for r in rows)
+        return {"steps": len(rows), "step_s": wall / len(rows), "tokens_per_s": sum(r["real_tokens"] for r in rows) / wall,
+                "data_share": data / wall, "peak_rss_mb": max(r["peak_rss_mb"] for r in self.rows)}
+
+def _detached_copy(obj):
+    """Deep copy of a (nested) state dict with every tensor cloned, so training can keep mutating the originals."""
+    if torch.is_tensor(obj):
+        return obj.detach().clone()
+    if isinstance(obj, dict):
+        return {k: _detached_copy(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_detached_copy(v) for v in obj)
+    return copy.deepcopy(obj)
+
+CHECKPOINT_RE = re.compile(r"^checkpoint-(\d+)$")
+
+class AsyncCheckpointCallback(TrainerCallback):
+    """
+    Every `every` steps: copy the LoRA weights, optimizer/scheduler state, RNG state and TrainerState on the
+    training thread (MBs, not GBs: the base model is frozen and never saved), then write them from a
+    background thread as <output_dir>/checkpoint-<step>/ in the Trainer's own layout, so
+    trainer.train(resume_from_checkpoint=...) restores them. Only the newest `keep` checkpoints stay.
+    Under DDP every rank's RNG state is gathered to rank 0 and written as rng_state_<rank>.pth.
+    With an `evaluator` (EvalStopCallback) its best weights and plateau bookkeeping are saved too.
+    """
+
+    def __init__(self, output_dir: Path, every: int, keep: int = 3, evaluator=None):
+        self.output_dir, self.every, self.keep, self.evaluator = output_dir, every, keep, evaluator
+        self.pool = ThreadPoolExecutor(max_workers=1)  # one writer: saves land in step order
+        self.pending, self.saves = [], []
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        if state.is_world_process_zero:
+            for stale in self.output_dir.glob("checkpoint-*.tmp"):
+                shutil.rmtree(stale, ignore_errors=True)  # half-written by a run that was killed mid-save
+
+    def on_step_end(self, args, state, control, model=None, optimizer=None, lr_scheduler=None, **kwargs):
+        if state.global_step % self.every:
+            return
+        import numpy as np
+        t0 = time.perf_counter()
+        rng = {"python": random.getstate(), "numpy": np.random.get_state(), "cpu": torch.random.get_rng_state()}
+        rngs = [rng]
+        if args.world_size > 1:
+            # every rank takes part; Trainer._load_rng_state reads rng_state_<rank>.pth on each rank
+            rngs = [None] * args.world_size if state.is_world_process_zero else None
+            torch.distributed.gather_object(rng, rngs, dst=0)
+        if not state.is_world_process_zero:
+            return
+        snap = {"adapter": _detached_copy(get_peft_model_state_dict(model)),
+                "optimizer": _detached_copy(optimizer.state_dict()),
+                "scheduler": _detached_copy(lr_scheduler.state_dict()),
+                "rng": rngs,
+                "state": copy.deepcopy(state)}
+        if self.evaluator is not None:
+            snap["eval"] = copy.deepcopy(self.evaluator.state_dict())
+            snap["eval_best"] = self.evaluator.best_state  # a fresh clone per improvement, never mutated
+        blocking = time.perf_counter() - t0
+        self.pending.append(self.pool.submit(self._write, snap, model.peft_config[model.active_adapter],
+                                             state.global_step, blocking))
+
+    def _write(self, snap: dict, peft_cfg, step: int, blocking: float):
+        t0 = time.perf_counter()
+        final = self.output_dir / f"checkpoint-{step}"
+        tmp = final.with_name(final.name + ".tmp")  # not matched by get_last_checkpoint until renamed
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir(parents=True)
+        save_file(snap["adapter"], str(tmp / "adapter_model.safetensors"), metadata={"format": "pt"})
+        peft_cfg.save_pretrained(str(tmp))
+        torch.save(snap["optimizer"], tmp / "optimizer.pt")
+        torch.save(snap["scheduler"], tmp / "scheduler.pt")
+        if len(snap["rng"]) == 1:
+            torch.save(snap["rng"][0], tmp / "rng_state.pth")
+        else:
+            for rank, rng in enumerate(snap["rng"]):
+                torch.save(rng, tmp / f"rng_state_{rank}.pth")
+        snap["state"].save_to_json(str(tmp / "trainer_state.json"))
+        if "eval" in snap:
+            with open(tmp / "eval_state.json", "w", encoding="utf-8") as f:
+                json.dump(snap["eval"], f)
+            if snap["eval_best"] is not None:
+                save_file(snap["eval_best"], str(tmp / "eval_best_adapter.safetensors"), metadata={"format": "pt"})
+        shutil.rmtree(final, ignore_errors=True)
+        tmp.rename(final)
+        # same pattern as get_last_checkpoint: a *.tmp left by a killed write is neither kept nor counted
+        ckpts = sorted((d for d in self.output_dir.iterdir() if CHECKPOINT_RE.match(d.name) and d.is_dir()),
+                       key=lambda d: int(CHECKPOINT_RE.match(d.name).group(1)))
+        for old in ckpts[:-self.keep]:
+            shutil.rmtree(old, ignore_errors=True)
+        size_mb = sum(f.stat().st_size for f in final.iterdir()) / 2**20
+        write = time.perf_counter() - t0
+        self.saves.append({"step": step, "blocking_s": blocking, "write_s": write, "size_mb": size_mb})
+        print(f"[ckpt] step {step} → {final.name}: {1000 * blocking:.0f} ms on the training loop, "
+              f"{write:.2f}s written in the background ({size_mb:.1f} MB)")
+
+    def on_train_end(self, args, state, control, **kwargs):
+        for f in self.pending:
+            f.result()  # surface write errors, and never exit with a half-written checkpoint
+        self.pool.shutdown()
+        if self.saves:
+            n = len(self.saves)
+            print(f"[ckpt] {n} saves: {1000 * sum(x['blocking_s'] for x in self.saves) / n:.0f} ms blocking per save "
+                  f"vs {sum(x['write_s'] for x in self.saves) / n:.2f}s a synchronous write would have stalled; "
+                  f"kept the last {min(n, self.keep)}")
+
+def eval_pair(example: dict) -> Tuple[str, str]:
+    """Training row → (prompt rendered by guess_text() up to where the answer starts, reference answer)."""
+    msgs = example.get("messages")
+    if isinstance(msgs, list) and msgs and msgs[-1].get("role") == "assistant":
+        return guess_text({"messages": msgs[:-1]}), str(msgs[-1].get("content", ""))
+    ref = example.get("output") or example.get("response") or example.get("target") or ""
+    return guess_text({**example, "output": "", "response": "", "target": ""}), str(ref)
+
+def split_heldout(train_path: Path, out_dir: Path, rows: int, seed: int = 42) -> Tuple[Path, List[dict]]:
+    """
+    Seeded sample of `rows` train examples for the in-training eval. The other rows are written to
+    <out_dir>/train_split.jsonl, which training then reads, so nothing scored was trained on.
+    """
+    with open(train_path, "r", encoding="utf-8", errors="ignore") as f:
+        n = sum(1 for line in f if line.strip())
+    if rows >= n:
+        raise ValueError(f"--eval_rows {rows} would hold out all {n} rows of {train_path.name}; "
+                         f"lower it or pass a dev set with --eval_file")
+    held = set(random.Random(seed).sample(range(n), rows))
+    split_path, heldout, i = out_dir / "train_split.jsonl", [], 0
+    with open(train_path, "r", encoding="utf-8", errors="ignore") as f, \
+            open(split_path, "w", encoding="utf-8") as wf:
+        for line in f:
+            if not line.strip():
+                continue
+            if i in held:
+                heldout.append(json.loads(line))
+            else:
+                wf.write(line if line.endswith("\n") else line + "\n")
+            i += 1
+    return split_path, heldout
+
+EVAL_METRICS = ("overlap", "lcs", "tfidf", "mean")
+
+class EvalStopCallback(TrainerCallback):
+    """
+    Every `every` optimizer steps: greedy generations for a few held-out prompts, scored in-process with
+    score_actions_min's Overlap/LCS/TF-IDF. The LoRA weights of the best `metric` so far are kept in
+    memory (a few MB) and put back before saving; training stops after `patience` evals without a gain
+    of `min_delta`. One line per eval goes to <output_name>/eval_log.jsonl.
+    """
+
+    def __init__(self, model, tok, prompts: List[str], refs: List[str], every: int, metric: str = "mean",
+                 patience: int = 3, min_delta: float = 0.002, max_new_tokens: int = 64, batch_size: int = 8,
+                 log_path: Optional[Path] = None, clock: Optional[ThroughputCallback] = None):
+        self.model, self.tok, self.prompts, self.refs = model, tok, prompts, refs
+        self.every, self.metric, self.patience, self.min_delta = every, metric, patience, min_delta
+        self.batch_size, self.log_path, self.clock = batch_size, log_path, clock
+        self.gen_kwargs = gen_kwargs_from_args(tok, argparse.Namespace(max_new_tokens=max_new_tokens,
+                                                                       temperature=0.0, greedy=True))
+        self.gen_kwargs["use_cache"] = True  # --memory_budget turns the KV cache off for training
+        self.best, self.best_step, self.best_state, self.bad_evals = None, 0, None, 0
+        self.history, self.seconds = [], 0.0
+
+    def evaluate(self) -> dict:
+        t0 = time.perf_counter()
+        was_training, side = self.model.training, self.tok.padding_side
+        self.model.eval()
+        self.tok.padding_side = "left"  # decoder-only batches continue from each row's last token
+        try:
+            preds = []
+            for i in range(0, len(self.prompts), self.batch_size):
+                preds += generate_batch(self.tok, self.model, self.prompts[i:i + self.batch_size], self.gen_kwargs)
+        finally:
+            self.tok.padding_side = side
+            self.model.train(was_training)
+        avg = lambda xs: sum(xs) / len(xs)
+        scores = {"overlap": avg([jaccard(p, r) for p, r in zip(preds, self.refs)]),
+                  "lcs": avg([lcs_norm(p, r) for p, r in zip(preds, self.refs)]),
+                  "tfidf": avg(tfidf_cosine_batch(preds, self.refs))}
+        scores["mean"] = avg(list(scores.values()))
+        scores["seconds"] = time.perf_counter() - t0
+        return scores
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if state.global_step % self.every:
+            return
+        scores = self.evaluate()
+        self.seconds += scores["seconds"]
+        score = scores[self.metric]
+        improved = self.best is None or score > self.best + self.min_delta
+        if improved:
+            self.best, self.best_step, self.bad_evals = score, state.global_step, 0
+            self.best_state = {k: v.detach().clone() for k, v in get_peft_model_state_dict(self.model).items()}
+        else:
+            self.bad_evals += 1
+        row = {"step": state.global_step, **{k: round(v, 4) for k, v in scores.items()}, "best": improved}
+        self.history.append(row)
+        if self.log_path:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(row) + "\n")
+        print(f"[eval] step {state.global_step}: overlap {scores['overlap']:.4f} | lcs {scores['lcs']:.4f} | "
+              f"tfidf {scores['tfidf']:.4f} | mean {scores['mean']:.4f} ({scores['seconds']:.1f}s)"
+              f"{'  ← best' if improved else f'  (no gain {self.bad_evals}/{self.patience})'}")
+        if self.bad_evals >= self.patience:
+            print(f"[eval] {self.metric} plateaued; stopping at step {state.global_step} of {args.max_steps} "
+                  f"(best {self.best:.4f} at step {self.best_step})")
+            control.should_training_stop = True
+        if self.clock:
+            self.clock.restart_clock()
+
+    def restore_best(self):
+        """Load the best LoRA weights seen into the model (no-op before the first eval)."""
+        if self.best_state is not None:
+            set_peft_model_state_dict(self.model, self.best_state)
+
+    def state_dict(self) -> dict:
+        """Plateau bookkeeping for AsyncCheckpointCallback (the best weights are saved beside it)."""
+        return {"best": self.best, "best_step": self.best_step, "bad_evals": self.bad_evals, "history": self.history}
+
+    def load_checkpoint(self, ckpt_dir: Path) -> bool:
+        """
+        --resume: take the best score/weights, patience count and eval history from a checkpoint, and
+        rewrite eval_log.jsonl to match it. False if the checkpoint was saved without eval state.
+        """
+        info = ckpt_dir / "eval_state.json"
+        if not info.exists():
+            return False
+        with open(info, "r", encoding="utf-8") as f:
+            st = json.load(f)
+        self.best, self.best_step, self.bad_evals, self.history = st["best"], st["best_step"], st["bad_evals"], st["history"]
+        best = ckpt_dir / "eval_best_adapter.safetensors"
+        self.best_state = load_file(str(best)) if best.exists() else None
+        if self.log_path:
+            with open(self.log_path, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(row) + "\n" for row in self.history)
+        return True
+
+def _parse_cpulist(text: str) -> List[int]:
+    cores = []
+    for part in text.strip().split(","):
+        if part:
+            lo, _, hi = part.partition("-")
+            cores += range(int(lo), int(hi or lo) + 1)
+    return cores
+
+def rank_cores(local_rank: int, world: int) -> List[int]:
+    """
+    Cores for one DDP rank. Ranks are spread over NUMA nodes (from /sys/devices/system/node):
+    fewer ranks than nodes → each rank gets whole nodes; more → ranks sharing a node split its cores.
+    Without NUMA info all allowed cores count as one node.
+    """
+    allowed = set(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else set(range(os.cpu_count() or 1))
+    nodes = []
+    for d in sorted(Path("/sys/devices/system/node").glob("node[0-9]*"), key=lambda d: int(d.name[4:])):
+        cores = sorted(set(_parse_cpulist((d / "cpulist").read_text())) & allowed)
+        if cores:
+            nodes.append(cores)
+    if not nodes:
+        nodes = [sorted(allowed)]
+    n = len(nodes)
+    if world <= n:
+        return [c for k in range(local_rank * n // world, (local_rank + 1) * n // world) for c in nodes[k]]
+    node = local_rank * n // world
+    peers = [r for r in range(world) if r * n // world == node]
+    per = max(1, len(nodes[node]) // len(peers))
+    i = peers.index(local_rank)
+    return nodes[node][i * per:(i + 1) * per] or nodes[node]
+
+def launch_ddp(nproc: int):
+    """Re-run this script under torchrun with `nproc` local processes (gloo, single host)."""
+    # torchrun's parser would take a forwarded --nproc as an abbreviation of its own --nproc-per-node
+    # (and exit); the children see LOCAL_RANK and do not need it
+    argv, rest = [], iter(sys.argv[1:])
+    for a in rest:
+        if a == "--nproc":
+            next(rest, None)
+        elif not a.startswith("--nproc="):
+            argv.append(a)
+    cmd = [sys.executable, "-m", "torch.distributed.run", "--standalone", f"--nproc_per_node={nproc}",
+           str(Path(__file__).resolve()), *argv]
+    print(f"[ddp] launching {nproc} processes: {' '.join(cmd[1:])}")
+    subprocess.run(cmd, check=True)
+
+def log_train_throughput(args, world: int, threads: int, seconds: float, real_tokens: float):
+    """Append one row to OUTPUT_DIR/train_throughput.csv (same spirit as run_log.csv)."""
+    log = P.OUTPUT_DIR / "train_throughput.csv"
+    header = ["output_name", "processes", "threads_per_process", "batch_size", "grad_accum", "pack",
+              "max_steps", "seconds", "real_tokens_per_s"]
+    exists = log.exists()
+    with open(log, "a", newline="", encoding="utf-8") as wf:
+        w = csv.writer(wf)
+        if not exists: w.writerow(header)
+        w.writerow([args.output_name, world, threads, args.batch_size, args.grad_accum, int(args.pack),
+                    args.max_steps, f"{seconds:.2f}", f"{real_tokens / seconds:.2f}"])
+
+def log_train_run(args, summary: dict):
+    """Training summary as a run_log.csv row (score columns stay empty until log_run.py scores the adapter)."""
+    log = P.OUTPUT_DIR / "run_log.csv"
+    header = ["adapter","base_model","dataset","max_new_tokens","temperature","avg_overlap","avg_lcs","avg_tfidf","notes"]
+    notes = (f"train: {summary['steps']} steps @ {summary['step_s']:.2f}s, {summary['tokens_per_s']:.1f} real tok/s, "
+             f"data {100 * summary['data_share']:.0f}% of step time, peak RSS {summary['peak_rss_mb']:.0f} MB")
+    exists = log.exists()
+    with open(log, "a", newline="", encoding="utf-8") as wf:
+        w = csv.writer(wf)
+        if not exists: w.writerow(header)
+        w.writerow([args.output_name, args.base_model, Path(args.train_file).stem, "", "", "", "", "", notes])
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--base_model", default="TinyLlama/TinyLlama-1.1B-Chat-v1.0")
@@ -55,7 +669,69 @@ def main():
     ap.add_argument("--output_name", default="lora_tinyllama_min")
     ap.add_argument("--max_steps", type=int, default=30)
     ap.add_argument("--max_length", type=int, default=768)
+    ap.add_argument("--batch_size", type=int, default=1, help="Rows per optimizer micro-batch.")
+    ap.add_argument("--grad_accum", type=int, default=1, help="Micro-batches per optimizer step.")
+    ap.add_argument("--pad_to_max_length", action="store_true",
+                    help="Old behaviour: pad every row to --max_length (for before/after throughput comparisons).")
+    ap.add_argument("--pack", action="store_true",
+                    help="Pack examples (EOS-separated) into --max_length blocks; attention and positions reset per example.")
+    ap.add_argument("--num_proc", type=int, default=min(8, os.cpu_count() or 1),
+                    help="Processes for tokenizing large train files (small files stay single-process).")
+    ap.add_argument("--refresh_data_cache", action="store_true",
+                    help="Re-tokenize even if output/tokenized_cache has this file/tokenizer/length combination.")
+    ap.add_argument("--memory_budget", action="store_true",
+                    help="Lower training RAM: activation checkpointing on the decoder layers + bf16 autocast "
+                         "(when the CPU has native bf16).")
+    ap.add_argument("--bf16_weights", action="store_true",
+                    help="Also keep the frozen base weights in bf16 (LoRA weights stay fp32); implies bf16 autocast.")
+    ap.add_argument("--streaming", action="store_true",
+                    help="Read and tokenize the train file lazily (constant memory, no cache); needs --max_steps.")
+    ap.add_argument("--shuffle_buffer", type=int, default=10000,
+                    help="--streaming: rows held for shuffling (0 = file order).")
+    ap.add_argument("--profile_steps", type=int, nargs=2, metavar=("FIRST", "LAST"),
+                    help="torch.profiler over optimizer steps FIRST..LAST → <output_name>/train_trace.json.")
+    ap.add_argument("--eval_every", type=int, default=0,
+                    help="Every K steps, score greedy generations on held-out prompts; stop on plateau (0 = off).")
+    ap.add_argument("--eval_file", default=None,
+                    help="Dev set in the train-file schema; default: hold out --eval_rows rows of --train_file "
+                         "(never the test_prompts/test_refs used for reported scores).")
+    ap.add_argument("--eval_rows", type=int, default=16, help="Held-out rows scored per eval.")
+    ap.add_argument("--eval_max_new_tokens", type=int, default=64)
+    ap.add_argument("--eval_metric", choices=EVAL_METRICS, default="mean",
+                    help="Score that decides the best adapter and the plateau (mean = average of the three).")
+    ap.add_argument("--patience", type=int, default=3, help="Evals without improvement before stopping.")
+    ap.add_argument("--min_delta", type=float, default=0.002, help="Smallest gain that counts as improvement.")
+    ap.add_argument("--ckpt_every", type=int, default=0,
+                    help="Adapter-only checkpoint (LoRA + optimizer + RNG) every K steps, written in the background (0 = off).")
+    ap.add_argument("--keep_ckpts", type=int, default=3, help="Checkpoints kept (oldest deleted first).")
+    ap.add_argument("--resume", action="store_true",
+                    help="Continue from the newest checkpoint-<step>/ in output/<output_name>/.")
+    ap.add_argument("--nproc", type=int, default=1,
+                    help="Data-parallel training processes (gloo DDP), each pinned to its own NUMA node / core set.")
     args = ap.parse_args()
+    if args.pack and args.pad_to_max_length:
+        raise ValueError("--pack already fills every block to --max_length; drop --pad_to_max_length")
+    if args.eval_every and args.nproc > 1:
+        raise ValueError("--eval_every generates on one process; run it with --nproc 1")
+    if args.profile_steps and not 1 <= args.profile_steps[0] <= args.profile_steps[1]:
+        raise ValueError("--profile_steps FIRST LAST needs 1 <= FIRST <= LAST")
+    if args.streaming and args.pad_to_max_length:
+        raise ValueError("--streaming pads per batch; drop --pad_to_max_length")
+    if args.streaming and args.max_steps <= 0:
+        raise ValueError("--streaming has no dataset length; set --max_steps")
+
+    # --nproc N: re-run this script under torchrun; the N children see LOCAL_RANK and train
+    rank, world = int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1))
+    if args.nproc > 1 and "LOCAL_RANK" not in os.environ:
+        launch_ddp(args.nproc)
+        return
+    is_main = rank == 0
+    if world > 1:
+        cores = rank_cores(int(os.environ["LOCAL_RANK"]), world)
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+        print(f"[ddp] rank {rank}/{world}: cores {cores[0]}–{cores[-1]} ({len(cores)} threads)")
 
     # Paths
     P.ensure_dirs()
@@ -66,70 +742,168 @@ def main():
     tok = AutoTokenizer.from_pretrained(args.base_model, use_fast=True)
     if tok.pad_token is None:
         tok.pad_token = tok.eos_token
+    # batches are padded on the right so real tokens keep positions 0..n-1 (inference re-pads on the left)
+    tok.padding_side = "right"
 
-    model = AutoModelForCausalLM.from_pretrained(args.base_model)
-
-    # LoRA config — tiny & fast
-    lora_cfg = LoraConfig(
-        task_type=TaskType.CAUSAL_LM,
-        r=8,
-        lora_alpha=16,
-        lora_dropout=0.05,
-        target_modules=["q_proj","k_proj","v_proj","o_proj","gate_proj","up_proj","down_proj"], # works for most Llama-like models
-        bias="none"
-    )
-    model = get_peft_model(model, lora_cfg)
-
-    # Data
-    train_path = Path(args.train_file)
-    if not train_path.exists():
-        raise FileNotFoundError(f"Training file not found: {train_path}")
+    # --memory_budget: bf16 autocast only where the CPU runs bf16 natively; --bf16_weights asks for it explicitly
+    autocast = args.bf16_weights or (args.memory_budget and cpu_bf16_supported())
+    if args.memory_budget and is_main:
+        print(f"[memory] gradient checkpointing on | bf16 autocast {'on' if autocast else 'off (no native CPU bf16)'}"
+              f" | frozen weights {'bf16' if args.bf16_weights else 'fp32'}")
+    model = AutoModelForCausalLM.from_pretrained(
+        args.base_model, torch_dtype=torch.bfloat16 if args.bf16_weights else torch.float32)
+    if args.memory_budget:
+        model.config.use_cache = False  # the KV cache is useless in training and clashes with checkpointing
 
-    ds = load_dataset("json", data_files=str(train_path), split="train")
-
-    def to_text(ex):
-        txt = guess_text(ex)
-        return {"text": txt}
-
-    def tokenize(ex):
-        enc = tok(
-            ex["text"], truncation=True, max_length=args.max_length,
-            padding="max_length", return_tensors=None
-        )
-        # causal LM: labels are input_ids
-        enc["labels"] = enc["input_ids"].copy()
-        return enc
-
-    ds = ds.map(to_text, remove_columns=ds.column_names)
-    ds = ds.map(tokenize, batched=False)
-
-    collator = DataCollatorForLanguageModeling(tok, mlm=False)
+    model = get_peft_model(model, lora_config())
+    if args.bf16_weights:
+        # optimizer state and updates stay in fp32; only the frozen base is stored in bf16
+        for prm in model.parameters():
+            if prm.requires_grad:
+                prm.data = prm.data.float()
 
     # Training
     targs = TrainingArguments(
         output_dir=str(out_dir),
         max_steps=args.max_steps,
-        per_device_train_batch_size=1,
-        gradient_accumulation_steps=1,
+        per_device_train_batch_size=args.batch_size,
+        gradient_accumulation_steps=args.grad_accum,
+        group_by_length=not (args.pad_to_max_length or args.pack or args.streaming),
+        length_column_name="length",
+        remove_unused_columns=not args.pack,  # PackedCollator reads position_ids itself
         learning_rate=2e-4,
         warmup_ratio=0.03,
         logging_steps=5,
+        save_strategy="no" if args.ckpt_every else "steps",  # --ckpt_every saves in the background instead
         save_steps=args.max_steps,
-        bf16=False, fp16=False,  # CPU
-        report_to="none"
+        bf16=autocast, fp16=False,  # CPU: bf16 → torch.autocast("cpu", dtype=torch.bfloat16)
+        gradient_checkpointing=args.memory_budget,
+        gradient_checkpointing_kwargs={"use_reentrant": False},  # non-reentrant: works with frozen embeddings
+        report_to="none",
+        ddp_backend="gloo" if world > 1 else None,
+        ddp_find_unused_parameters=False,  # DDP only all-reduces params with requires_grad, i.e. the LoRA weights
     )
 
+    # Data
+    train_path = Path(args.train_file)
+    if not train_path.exists():
+        raise FileNotFoundError(f"Training file not found: {train_path}")
+    heldout = []
+    if args.eval_every:
+        if args.eval_file:
+            with open(args.eval_file, "r", encoding="utf-8", errors="ignore") as f:
+                heldout = [json.loads(line) for line in f if line.strip()][:args.eval_rows]
+        else:
+            train_path, heldout = split_heldout(train_path, out_dir, args.eval_rows)
+            print(f"[eval] held out {len(heldout)} rows of {Path(args.train_file).name}; training on {train_path}")
+
+    if args.streaming:
+        # nothing is read up front; the Trainer pulls rows until max_steps (each DDP rank keeps its slice)
+        ds = StreamingSFT(train_path, tok, args.max_length, args.pack, args.shuffle_buffer)
+    else:
+        # under DDP rank 0 tokenizes (or finds the cache) first; the other ranks then read its cache
+        with targs.main_process_first(desc="tokenized dataset"):
+            ds, info = build_train_dataset(train_path, tok, args.max_length, args.pad_to_max_length, args.pack,
+                                           args.num_proc, args.refresh_data_cache)
+    if args.pack:
+        collator = PackedCollator(torch.bfloat16 if args.bf16_weights else torch.float32)
+    else:
+        # causal LM: the collator sets labels = input_ids with pad positions set to -100 (ignored by the loss)
+        collator = DataCollatorForLanguageModeling(tok, mlm=False)
+
+    if args.streaming:
+        report = (f"[data] streaming {train_path.name} ({train_path.stat().st_size / 2**20:.1f} MB) "
+                  f"{'packed into ' + str(args.max_length) + '-token blocks' if args.pack else 'row by row'}, "
+                  f"shuffle buffer {args.shuffle_buffer or 'off'}, {args.max_steps} steps")
+    elif args.pack:
+        lengths = ds["length"]  # real tokens per training row (per block when packing)
+        n_examples, example_tokens = info["examples"], info["example_tokens"]
+        eff = sum(lengths) / (len(lengths) * args.max_length)
+        report = (f"[pack] {n_examples} examples ({example_tokens} tokens + EOS) → {len(lengths)} blocks of "
+                  f"{args.max_length}: {n_examples / len(lengths):.1f} examples/block, {100 * eff:.1f}% real tokens; "
+                  f"a training row now carries {(sum(lengths) / len(lengths)) / (example_tokens / n_examples):.1f}x "
+                  f"the real tokens of an unpacked row")
+    else:
+        lengths = ds["length"]
+        eff_max = padding_efficiency(lengths, args.batch_size, args.max_length)
+        eff_dyn = padding_efficiency(lengths, args.batch_size)
+        eff = eff_max if args.pad_to_max_length else eff_dyn
+        report = (f"[padding] {len(lengths)} rows, {sum(lengths)} real tokens; padding efficiency "
+                  f"pad-to-{args.max_length}: {100 * eff_max:.1f}% | per-batch, length-grouped (bs={args.batch_size}): "
+                  f"{100 * eff_dyn:.1f}%  → this run uses {'pad-to-max' if args.pad_to_max_length else 'per-batch'}")
+    if is_main:
+        print(report)
+
+    speed = ThroughputCallback(collator, out_dir / "train_metrics.jsonl",
+                               tuple(args.profile_steps) if args.profile_steps else None)
+    callbacks = [MemoryCallback(), speed]
+    stopper = None
+    if args.eval_every:
+        prompts, refs = map(list, zip(*(eval_pair(ex) for ex in heldout))) if heldout else ([], [])
+        if not any(refs):
+            raise ValueError("no reference answers in the held-out rows (need messages ending in an assistant "
+                             "turn, or output/response/target)")
+        (out_dir / "eval_log.jsonl").unlink(missing_ok=True)
+        stopper = EvalStopCallback(model, tok, prompts, refs, args.eval_every, args.eval_metric, args.patience,
+                                   args.min_delta, args.eval_max_new_tokens, log_path=out_dir / "eval_log.jsonl",
+                                   clock=speed)
+        callbacks.append(stopper)  # after `speed`, so eval time is not booked as step time
+        print(f"[eval] every {args.eval_every} steps: {len(prompts)} held-out rows, "
+              f"{args.eval_max_new_tokens} new tokens, stop after {args.patience} evals without +{args.min_delta} {args.eval_metric}")
+    if args.ckpt_every:
+        # after the evaluator, so a checkpoint taken on an eval step includes that eval
+        callbacks.append(AsyncCheckpointCallback(out_dir, args.ckpt_every, args.keep_ckpts, evaluator=stopper))
     trainer = Trainer(
         model=model,
         args=targs,
         train_dataset=ds,
-        data_collator=collator,
+        data_collator=speed.collate,
         tokenizer=tok,
+        callbacks=callbacks,
     )
 
-    trainer.train()
+    resume_from = None
+    if args.resume:
+        resume_from = get_last_checkpoint(str(out_dir))
+        if world > 1:
+            # accelerate puts a CPU rank on device "cpu:0", which the Trainer passes to torch.load as
+            # map_location for optimizer.pt; torch's own CPU deserializer only knows "cpu"
+            torch.serialization.register_package(
+                11, lambda obj: None, lambda obj, location: obj if location.startswith("cpu:") else None)
+        if is_main:
+            print(f"[ckpt] resuming from {resume_from}" if resume_from else
+                  f"[ckpt] no checkpoint-<step>/ in {out_dir}; starting from step 0")
+        if stopper and resume_from:
+            if stopper.load_checkpoint(Path(resume_from)):
+                print(f"[eval] restored {len(stopper.history)} evals; best {stopper.best} at step {stopper.best_step}")
+            else:
+                print(f"[eval] {resume_from} has no eval state; the best-adapter tracking starts over")
+    result = trainer.train(resume_from_checkpoint=resume_from)
+    if not is_main:
+        return  # rank 0 logs and saves; every rank holds the same LoRA weights after the all-reduce
+    runtime = result.metrics["train_runtime"] - (stopper.seconds if stopper else 0.0)
+    steps = trainer.state.global_step  # < max_steps after an early stop
+    if args.streaming:
+        real = ds.real_tokens  # tokens actually pulled from the stream (all ranks' slices pass through here)
+        print(f"[throughput] {real / runtime:.1f} real tokens/s over {runtime:.1f}s with {world} process(es) "
+              f"× {torch.get_num_threads()} threads ({ds.passes} pass(es) over the file)")
+    else:
+        # rows the samplers handed out (on every rank), at the dataset's average real length
+        real = steps * args.batch_size * args.grad_accum * world * sum(lengths) / len(lengths)
+        print(f"[throughput] {real / runtime:.1f} real tokens/s ({real / eff / runtime:.1f} incl. padding) "
+              f"over {runtime:.1f}s with {world} process(es) × {torch.get_num_threads()} threads")
+    log_train_throughput(args, world, torch.get_num_threads(), runtime, real)
+    summary = speed.summary()
+    print(f"[steps] {summary['step_s']:.2f}s/step, {summary['tokens_per_s']:.1f} real tok/s on this rank, "
+          f"data loading {100 * summary['data_share']:.0f}% of step time (step 1 excluded)")
+    log_train_run(args, summary)
+
+    if stopper and stopper.best_state is not None:
+        stopper.restore_best()
+        print(f"[eval] keeping the step-{stopper.best_step} weights ({args.eval_metric} {stopper.best:.4f}); "
+              f"trained {steps}/{args.max_steps} steps, {stopper.seconds:.1f}s in eval")
 
-    # Save LoRA adapter
+    # Save LoRA adapter (the PeftModel itself, not the DDP wrapper → same files as a single-process run)
     model.save_pretrained(str(out_dir))
     tok.save_pretrained(str(out_dir))
     print(f"✅ Saved LoRA adapter to: {out_dir}")